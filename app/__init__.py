@@ -6,13 +6,19 @@
 import io
 import re
 import sys
-import qrcode
+import json
+import hashlib
+import time
+import threading
 import configparser
 
+from datetime import datetime
+from functools import wraps
 from http import HTTPStatus
 from urllib.parse import urlparse
 from flask_sqlalchemy import SQLAlchemy
-from flask import Flask, request, jsonify, send_file
+from flask_sqlalchemy.session import Session
+from flask import Flask, Response, request, jsonify, send_file, g, has_app_context, stream_with_context
 from configparser import UNNAMED_SECTION
 
 
@@ -21,7 +27,7 @@ config_file = 'verifactu.conf'
 time_zone = 'Europe/Madrid' # 'Atlantic/Canary' para Canarias
 
 
-def create_app():
+def create_app(schema=True):
     config = configparser.ConfigParser(allow_unnamed_section=True)
     config.read(config_file)
     debug = config.getboolean(UNNAMED_SECTION, 'debug', fallback=False)
@@ -31,49 +37,130 @@ def create_app():
     mysql_user = config.get(UNNAMED_SECTION, 'mysql_user', fallback='')
     mysql_password = config.get(UNNAMED_SECTION, 'mysql_password', fallback='')
     mysql_database = config.get(UNNAMED_SECTION, 'mysql_database', fallback='')
+    mysql_read_host = config.get(UNNAMED_SECTION, 'mysql_read_host', fallback='')
+    mysql_read_port = config.getint(UNNAMED_SECTION, 'mysql_read_port', fallback=mysql_port)
+    mysql_pool_size = config.getint(UNNAMED_SECTION, 'mysql_pool_size', fallback=5)
+    mysql_max_overflow = config.getint(UNNAMED_SECTION, 'mysql_max_overflow', fallback=10)
+    mysql_pool_recycle = config.getint(UNNAMED_SECTION, 'mysql_pool_recycle', fallback=3600)
+    mysql_pool_pre_ping = config.getboolean(UNNAMED_SECTION, 'mysql_pool_pre_ping', fallback=True)
+    idempotency_ttl = config.getint(UNNAMED_SECTION, 'idempotency_ttl', fallback=86400)
+    idempotency_stale = config.getint(UNNAMED_SECTION, 'idempotency_stale', fallback=60)
+    invoice_cache.ttl = config.getint(UNNAMED_SECTION, 'invoice_cache_ttl', fallback=300)
+    invoice_cache.size = config.getint(UNNAMED_SECTION, 'invoice_cache_size', fallback=10000)
 
     if not mysql_host or not mysql_user or not mysql_password or not mysql_database:
         print(f'No MySQL config in {config_file}')
         sys.exit(1)
 
     app.config['SQLALCHEMY_DATABASE_URI'] = f'mysql://{mysql_user}:{mysql_password}@{mysql_host}:{mysql_port}/{mysql_database}'
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': mysql_pool_size,
+        'max_overflow': mysql_max_overflow,
+        'pool_recycle': mysql_pool_recycle,
+        'pool_pre_ping': mysql_pool_pre_ping
+    }
+    if mysql_read_host:
+        app.config['SQLALCHEMY_BINDS'] = {
+            'read': f'mysql://{mysql_user}:{mysql_password}@{mysql_read_host}:{mysql_read_port}/{mysql_database}'
+        }
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     app.config['HOST'] = backend_url.hostname or 'localhost'
     app.config['PORT'] = backend_url.port or 8074
     app.config['DEBUG'] = debug
+    app.config['IDEMPOTENCY_TTL'] = idempotency_ttl
+    app.config['IDEMPOTENCY_STALE'] = idempotency_stale
     db.init_app(app)
-    with app.app_context():
-        from . import models
-        db.create_all()
+    if schema:
+        with app.app_context():
+            from . import models
+            db.create_all()
+            models.InvoiceVatTotal.backfill()
+            models.VatRollup.backfill()
 
     return app
 
 
-db = SQLAlchemy()
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_app_context() and g.get('read_only') and 'read' in db.engines:
+            return db.engines['read']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
 
 
-from .models import Company, Invoice
+def read_only(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        g.read_only = True
+        return f(*args, **kwargs)
+    return decorated
+
+
+class ResponseCache:
+    def __init__(self, ttl=300, size=10000):
+        self.ttl = ttl
+        self.size = size
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        item = self.items.get(key)
+        if item is None or item[0] < time.monotonic():
+            return None
+        return item[1]
+
+    def set(self, key, value):
+        if not self.ttl or not self.size:
+            return
+        with self.lock:
+            if len(self.items) >= self.size:
+                self.items.pop(next(iter(self.items)), None)
+            self.items[key] = (time.monotonic() + self.ttl, value)
+
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+invoice_cache = ResponseCache()
+
+
+from .models import Company, Invoice, IdempotencyKey, VatRollup
 from .verifactu import verifactuXML
 
 
 @app.route('/api/<int:company_id>/invoices', methods=['GET'])
+@read_only
 def get_invoices(company_id):
     return jsonify([invoice.to_dict() for invoice in Invoice.query.filter_by(company_id=company_id).order_by(Invoice.dt).all()])
 
 
 @app.route('/api/<int:company_id>/invoices/<int:id>', methods=['GET'])
+@read_only
 def get_invoice(company_id, id):
-    invoice = Invoice.query.filter_by(id=id, company_id=company_id).first()
-    if invoice is None:
+    # Version columns only, by primary key: changes from any process or node give a new cache key
+    version = Invoice.current_version(company_id, id)
+    if version is None:
         return jsonify({'error': 'Not found'}), HTTPStatus.NOT_FOUND
-    return jsonify(invoice.to_lines_dict())
+
+    body = invoice_cache.get((id, version))
+    if body is None:
+        invoice = Invoice.query.filter_by(id=id, company_id=company_id).first()
+        if invoice is None:
+            return jsonify({'error': 'Not found'}), HTTPStatus.NOT_FOUND
+        body = app.json.dumps(invoice.to_lines_dict())
+        version = invoice.get_version()
+        if invoice.is_final():
+            invoice_cache.set((id, version), body)
+
+    resp = app.response_class(body, mimetype='application/json')
+    resp.set_etag(version)
+    return resp.make_conditional(request)
 
 
 @app.route('/api/<int:company_id>/invoices/<int:id>/qr', methods=['GET'])
+@read_only
 def qr_invoice(company_id, id):
     invoice = Invoice.query.filter_by(id=id, company_id=company_id).first()
     if invoice is None:
         return jsonify({'error': 'Not found'}), HTTPStatus.NOT_FOUND
+    import qrcode
     img = qrcode.make(invoice.get_verifactu_qr())
     buf = io.BytesIO()
     img.save(buf, format='PNG')
@@ -86,24 +173,44 @@ def insertInvoice(company_id, type, ref=None, stype=None):
     if company is None:
         return jsonify({'error': 'Company not found'}), HTTPStatus.NOT_FOUND
 
-    data = {**request.json, 'company_id': company_id, 'verifactu_type': type, 'verifactu_stype': stype}
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return jsonify({'error': 'No JSON'}), HTTPStatus.UNSUPPORTED_MEDIA_TYPE
+
+    idempotency_id = None
+    key = request.headers.get('Idempotency-Key', '').strip()
+    if key:
+        if len(key) > 100:
+            return jsonify({'error': 'Idempotency-Key too long'}), HTTPStatus.BAD_REQUEST
+        request_hash = hashlib.sha256(f'{request.path}|{json.dumps(payload, sort_keys=True)}'.encode()).hexdigest()
+        idempotency_id, status = IdempotencyKey.claim(company_id, key, request_hash, app.config.get('IDEMPOTENCY_TTL', 86400),
+                                                      app.config.get('IDEMPOTENCY_STALE', 60))
+        if status:
+            return idempotency_id, status
+
+    try:
+        data = {**payload, 'company_id': company_id, 'verifactu_type': type, 'verifactu_stype': stype}
 
-    ret, status = Invoice.validate_fields(data)
-    if status:
-        return ret, status
+        ret, status = Invoice.validate_fields(data)
+        if status:
+            IdempotencyKey.release(idempotency_id)
+            return ret, status
 
-    if ref:
-        ret['invoice_ref_id'] = ref.id
+        if ref:
+            ret['invoice_ref_id'] = ref.id
 
-    try:
         invoice = Invoice(**ret)
         db.session.add(invoice)
         db.session.commit()
 
         ret, status = invoice.process_lines(data)
         if status:
+            IdempotencyKey.release(idempotency_id)
             return ret, status
+
+        IdempotencyKey.complete(idempotency_id, invoice.id)
     except Exception as e:
+        IdempotencyKey.release(idempotency_id)
         return jsonify({'error': str(e)}), HTTPStatus.BAD_REQUEST
 
     return jsonify({'id': invoice.id}), HTTPStatus.CREATED
@@ -189,3 +296,42 @@ def get_query(company_id):
     month = request.args.get('month', type=int, default=0)
     verifactuxml = verifactuXML()
     return jsonify(verifactuxml.consulta(company, year, month))
+
+
+@app.route('/api/<int:company_id>/reports/vat', methods=['GET'])
+@read_only
+def get_report_vat(company_id):
+    year = request.args.get('year', type=int, default=datetime.now().year)
+    period = request.args.get('period', default='quarter')
+    num = request.args.get('num', type=int, default=0)
+    verify = request.args.get('verify', type=int, default=0)
+    if period not in VatRollup.periods or num < 0 or num > VatRollup.periods[period]:
+        return jsonify({'error': 'Invalid period'}), HTTPStatus.BAD_REQUEST
+
+    resp = jsonify(VatRollup.report(company_id, year, period, num, verify))
+    resp.cache_control.private = True
+    resp.cache_control.no_cache = True
+    resp.add_etag()
+    return resp.make_conditional(request)
+
+
+@app.route('/api/<int:company_id>/export', methods=['GET'])
+@read_only
+def get_export(company_id):
+    company = db.session.get(Company, company_id)
+    if not company:
+        return jsonify({'error': 'Company not found'}), HTTPStatus.NOT_FOUND
+
+    format = request.args.get('format', default='ndjson')
+    if format not in ['csv', 'ndjson']:
+        return jsonify({'error': 'Invalid format'}), HTTPStatus.BAD_REQUEST
+
+    try:
+        filters = Invoice.export_filters(request.args.get('from'), request.args.get('to'), request.args.get('type'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), HTTPStatus.BAD_REQUEST
+
+    if format == 'csv':
+        return Response(stream_with_context(Invoice.export_csv(company, *filters)), mimetype='text/csv',
+                        headers={'Content-Disposition': f'attachment; filename=invoices_{company_id}.csv'})
+    return Response(stream_with_context(Invoice.export_ndjson(company, *filters)), mimetype='application/x-ndjson')
@@ -0,0 +1,113 @@
+#
+# Veri*Factu - 2025 Eduardo Ruiz <eruiz@dataclick.es>
+# https://github.com/EduardoRuizM/verifactu-api-python
+#
+
+import os
+import sys
+import json
+import argparse
+
+
+def init():
+    from app import create_app
+    app = create_app(schema=False)
+    app.app_context().push()
+
+    from app.verifactu import verifactuXML
+    return verifactuXML()
+
+
+def company(company_id):
+    from app import db
+    from app.models import Company
+    company = db.session.get(Company, company_id)
+    if company is None:
+        sys.exit(f'Company {company_id} not found')
+    return company
+
+
+def output(data):
+    print(json.dumps(data, indent=2, ensure_ascii=False, default=str))
+
+
+def cmd_send(args):
+    output(init().pending())
+
+
+def cmd_query(args):
+    verifactuxml = init()
+    output(verifactuxml.consulta(company(args.company_id), args.year, args.month))
+
+
+def cmd_verify_chain(args):
+    verifactuxml = init()
+    ret = verifactuxml.verify_chain(company(args.company_id), args.year, args.month)
+    output(ret)
+    return 0 if ret.get('ok') else 1
+
+
+def cmd_export(args):
+    init()
+    from app.models import Invoice
+    try:
+        filters = Invoice.export_filters(args.dt_from, args.dt_to, args.type)
+    except ValueError as e:
+        sys.exit(str(e))
+
+    export = Invoice.export_csv if args.format == 'csv' else Invoice.export_ndjson
+    for chunk in export(company(args.company_id), *filters):
+        sys.stdout.write(chunk)
+
+
+def cmd_stats(args):
+    output(init().stats())
+
+
+def cmd_fetch_xsd(args):
+    import urllib.request
+    from app.verifactu import xsd_urls
+    os.makedirs(args.path, exist_ok=True)
+    for url in xsd_urls:
+        file_path = os.path.join(args.path, url.rsplit('/', 1)[1])
+        with urllib.request.urlopen(url, timeout=60) as response, open(file_path, 'wb') as f:
+            f.write(response.read())
+        print(file_path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='verifactu', description='Veri*Factu API (Python) operations')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    cmd = commands.add_parser('send', help='Send pending invoices to the AEAT (same as /api/process)')
+    cmd.set_defaults(func=cmd_send)
+
+    for name, func, help in [('query', cmd_query, 'Query records sent to the AEAT'),
+                             ('verify-chain', cmd_verify_chain, 'Verify fingerprints and chaining of records sent to the AEAT')]:
+        cmd = commands.add_parser(name, help=help)
+        cmd.add_argument('company_id', type=int)
+        cmd.add_argument('--year', type=int, default=0)
+        cmd.add_argument('--month', type=int, default=0)
+        cmd.set_defaults(func=func)
+
+    cmd = commands.add_parser('export', help='Export invoices with lines to stdout')
+    cmd.add_argument('company_id', type=int)
+    cmd.add_argument('--format', choices=['ndjson', 'csv'], default='ndjson')
+    cmd.add_argument('--from', dest='dt_from', help='YYYY-MM-DD')
+    cmd.add_argument('--to', dest='dt_to', help='YYYY-MM-DD')
+    cmd.add_argument('--type', help='Comma separated types (F1,F2...)')
+    cmd.set_defaults(func=cmd_export)
+
+    cmd = commands.add_parser('stats', help='Invoice counters by company')
+    cmd.set_defaults(func=cmd_stats)
+
+    cmd = commands.add_parser('fetch-xsd', help='Download the AEAT XSD used to validate records before sending')
+    cmd.add_argument('--path', default='./xsd', help='Same as verifactu_xsd_path')
+    cmd.set_defaults(func=cmd_fetch_xsd)
+
+    args = parser.parse_args(argv)
+    return args.func(args) or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,14 +3,19 @@
 # https://github.com/EduardoRuizM/verifactu-api-python
 #
 
+import io
 import re
+import csv
+import json
+import hashlib
 import urllib.parse
 
 from flask import jsonify
 from sqlalchemy import text
 from http import HTTPStatus
-from datetime import datetime
-from sqlalchemy.dialects.mysql import INTEGER
+from datetime import datetime, timedelta
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.mysql import INTEGER, SMALLINT
 
 from app import db
 
@@ -105,7 +110,8 @@ class Invoice(db.Model):
         return result
 
     def to_lines_dict(self):
-        return {**self.to_dict(), 'lines': [line.to_dict() for line in self.invoice_lines]}
+        local_error = db.session.query(InvoiceError.error).filter(InvoiceError.invoice_id == self.id).scalar()
+        return {**self.to_dict(), 'local_error': local_error, 'lines': [line.to_dict() for line in self.invoice_lines]}
 
     @staticmethod
     def validate_fields(data, element=None):
@@ -129,11 +135,83 @@ class Invoice(db.Model):
         self.num = (max_num + 1) if max_num else getattr(self.company, 'first_num', 1)
 
     def get_number_format(self):
-        f = 'formula' if not self.verifactu_type or self.verifactu_type[0] == 'F' else 'formula_r'
-        formula = getattr(self.company, f, None) or ('%n%' if self.verifactu_type[0] == 'F' else 'R-%n%')
-        return re.sub(r'%n(?:\.(\d+))?%',
-            lambda m: f'{self.num:0{int(m.group(1))}d}' if m.group(1) else str(self.num),
-            formula.replace('%y%', self.dt.strftime('%y')).replace('%Y%', self.dt.strftime('%Y')))
+        return number_format(self.company, self.verifactu_type, self.num, self.dt)
+
+    @staticmethod
+    def export(company, *filters, chunk=1000):
+        line_columns = [c for c in InvoiceLine.__table__.columns if c.name != 'invoice_id']
+        query = db.session.query(*Invoice.__table__.columns, *[c.label(f'line_{c.name}') for c in line_columns]).outerjoin(
+            InvoiceLine, InvoiceLine.invoice_id == Invoice.id
+        ).filter(Invoice.company_id == company.id, *filters).order_by(Invoice.dt, Invoice.id, InvoiceLine.num).yield_per(chunk)
+
+        invoice = None
+        for row in query:
+            if invoice is None or invoice['id'] != row.id:
+                if invoice is not None:
+                    yield invoice
+                invoice = {c.name: getattr(row, c.name) for c in Invoice.__table__.columns}
+                invoice['number_format'] = number_format(company, row.verifactu_type, row.num, row.dt)
+                invoice['dt'] = row.dt.strftime('%Y-%m-%d %H:%M:%S')
+                invoice['verifactu_dt'] = row.verifactu_dt.strftime('%Y-%m-%d %H:%M:%S') if row.verifactu_dt else None
+                invoice['lines'] = []
+            if row.line_num is not None:
+                invoice['lines'].append({c.name: getattr(row, f'line_{c.name}') for c in line_columns})
+        if invoice is not None:
+            yield invoice
+
+    @staticmethod
+    def export_filters(dt_from=None, dt_to=None, types=None):
+        try:
+            dt_from = datetime.strptime(dt_from, '%Y-%m-%d') if dt_from else None
+            dt_to = datetime.strptime(dt_to, '%Y-%m-%d') if dt_to else None
+        except ValueError:
+            raise ValueError('Invalid date, use YYYY-MM-DD')
+        if dt_from and dt_to and dt_from > dt_to:
+            raise ValueError('Invalid range, from is after to')
+
+        filters = []
+        if dt_from:
+            filters.append(Invoice.dt >= dt_from)
+        if dt_to:
+            filters.append(Invoice.dt < dt_to + timedelta(days=1))
+        types = [t.strip() for t in (types or '').upper().split(',') if t.strip()]
+        if types:
+            filters.append(Invoice.verifactu_type.in_(types))
+        return filters
+
+    @staticmethod
+    def export_ndjson(company, *filters):
+        for invoice in Invoice.export(company, *filters):
+            yield json.dumps(invoice, ensure_ascii=False, default=str) + '\n'
+
+    @staticmethod
+    def export_csv(company, *filters):
+        buf = io.StringIO()
+        fields = [c.name for c in Invoice.__table__.columns] + ['number_format'] +\
+                 [f'line_{c.name}' for c in InvoiceLine.__table__.columns if c.name != 'invoice_id']
+        writer = csv.DictWriter(buf, fieldnames=fields)
+        writer.writeheader()
+        for invoice in Invoice.export(company, *filters):
+            for line in invoice.pop('lines') or [{}]:
+                writer.writerow({**invoice, **{f'line_{k}': v for k, v in line.items()}})
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate(0)
+        yield buf.getvalue()
+
+    def get_version(self):
+        local_error = db.session.query(InvoiceError.error).filter(InvoiceError.invoice_id == self.id).scalar()
+        return invoice_version(self.id, self.verifactu_dt, self.verifactu_err, self.voided, self.fingerprint, self.verifactu_csv, local_error)
+
+    @staticmethod
+    def current_version(company_id, id):
+        row = db.session.query(Invoice.id, Invoice.verifactu_dt, Invoice.verifactu_err, Invoice.voided, Invoice.fingerprint, Invoice.verifactu_csv,
+                               InvoiceError.error).outerjoin(InvoiceError, InvoiceError.invoice_id == Invoice.id
+                               ).filter(Invoice.id == id, Invoice.company_id == company_id).first()
+        return invoice_version(*row) if row else None
+
+    def is_final(self):
+        return self.verifactu_dt is not None and self.verifactu_err == 0
 
     def get_verifactu_qr(self):
         return self.company.get_url_aeat() + 'wlpl/TIKE-CONT/ValidarQR?nif=' + urllib.parse.quote(self.company.vat_id) +\
@@ -148,6 +226,7 @@ class Invoice(db.Model):
 
     def process_lines(self, data):
         num = 0
+        totals = {}
         self.tvat = 0
         self.bi = 0
         self.total =  0
@@ -172,6 +251,15 @@ class Invoice(db.Model):
             self.tvat += invoice_line.tvat
             self.total += invoice_line.total
             db.session.add(invoice_line)
+
+            total = totals.setdefault(invoice_line.vat or 0, {'bi': 0, 'tvat': 0})
+            total['bi'] += invoice_line.bi
+            total['tvat'] += invoice_line.tvat
+
+        rows = [(vat, round(total['bi'], 2), round(total['tvat'], 2)) for vat, total in totals.items()]
+        for vat, bi, tvat in rows:
+            db.session.add(InvoiceVatTotal(invoice_id=self.id, vat=vat, bi=bi, tvat=tvat))
+        VatRollup.add(self.company_id, self.dt, self.verifactu_type, rows)
         db.session.commit()
         return None, None
 
@@ -200,6 +288,388 @@ class InvoiceLine(db.Model):
         return validate_fields(data, required, allowed, element)
 
 
+class InvoiceError(db.Model):
+    __tablename__ = 'invoice_errors'
+    invoice_id = db.Column(INTEGER(unsigned=True), db.ForeignKey('invoices.id', ondelete='CASCADE'), primary_key=True)
+    created = db.Column(db.DateTime, nullable=False)
+    error = db.Column(db.Text, nullable=False)
+
+    def __repr__(self):
+        return f'<InvoiceError {self.invoice_id}>'
+
+
+class InvoiceVatTotal(db.Model):
+    __tablename__ = 'invoice_vat_totals'
+    invoice_id = db.Column(INTEGER(unsigned=True), db.ForeignKey('invoices.id', ondelete='CASCADE'), primary_key=True)
+    vat = db.Column(INTEGER(unsigned=True), primary_key=True, default=0)
+    bi = db.Column(db.Float, nullable=False, default=0.0)
+    tvat = db.Column(db.Float, nullable=False, default=0.0)
+
+    def __repr__(self):
+        return f'<InvoiceVatTotal {self.invoice_id} {self.vat}>'
+
+    @staticmethod
+    def backfill():
+        # One-time fill of existing invoices, process_lines keeps the table up to date afterwards
+        if db.session.query(InvoiceVatTotal).first() is not None:
+            return
+        vat = db.func.coalesce(InvoiceLine.vat, 0)
+        lines = db.session.query(
+            InvoiceLine.invoice_id, vat, db.func.round(db.func.sum(InvoiceLine.bi), 2), db.func.round(db.func.sum(InvoiceLine.tvat), 2)
+        ).group_by(InvoiceLine.invoice_id, vat)
+        try:
+            db.session.execute(db.insert(InvoiceVatTotal).from_select(['invoice_id', 'vat', 'bi', 'tvat'], lines))
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+
+
+class VatRollup(db.Model):
+    __tablename__ = 'vat_rollups'
+    company_id = db.Column(INTEGER(unsigned=True), db.ForeignKey('companies.id', ondelete='CASCADE'), primary_key=True)
+    year = db.Column(SMALLINT(unsigned=True), primary_key=True)
+    month = db.Column(SMALLINT(unsigned=True), primary_key=True)
+    verifactu_type = db.Column(db.String(2), primary_key=True)
+    vat = db.Column(INTEGER(unsigned=True), primary_key=True)
+    invoices = db.Column(INTEGER(unsigned=True), nullable=False, default=0, server_default='0')
+    bi = db.Column(db.Float, nullable=False, default=0.0, server_default='0')
+    tvat = db.Column(db.Float, nullable=False, default=0.0, server_default='0')
+    voided = db.Column(INTEGER(unsigned=True), nullable=False, default=0, server_default='0')
+    voided_bi = db.Column(db.Float, nullable=False, default=0.0, server_default='0')
+    voided_tvat = db.Column(db.Float, nullable=False, default=0.0, server_default='0')
+    sent = db.Column(INTEGER(unsigned=True), nullable=False, default=0, server_default='0')
+
+    keys = ['company_id', 'year', 'month', 'verifactu_type', 'vat']
+    counters = ['invoices', 'bi', 'tvat', 'voided', 'voided_bi', 'voided_tvat', 'sent']
+    periods = {'month': 12, 'quarter': 4, 'year': 1}
+
+    def __repr__(self):
+        return f'<VatRollup {self.company_id} {self.year}-{self.month} {self.verifactu_type} {self.vat}>'
+
+    @staticmethod
+    def add(company_id, dt, verifactu_type, rows, voided=False, sent=0):
+        for vat, bi, tvat in rows:
+            if sent:
+                values = {'sent': sent}
+            elif voided:
+                values = {'voided': 1, 'voided_bi': bi, 'voided_tvat': tvat}
+            else:
+                values = {'invoices': 1, 'bi': bi, 'tvat': tvat}
+
+            key = {'company_id': company_id, 'year': dt.year, 'month': dt.month, 'verifactu_type': verifactu_type, 'vat': vat or 0}
+            deltas = {k: getattr(VatRollup, k) + v for k, v in values.items()}
+            if db.session.query(VatRollup).filter_by(**key).update(deltas, synchronize_session=False):
+                continue
+            try:
+                with db.session.begin_nested():
+                    db.session.add(VatRollup(**key, **values))
+            except IntegrityError:
+                db.session.query(VatRollup).filter_by(**key).update(deltas, synchronize_session=False)
+
+    @staticmethod
+    def compute(*filters):
+        year = db.extract('year', Invoice.dt)
+        month = db.extract('month', Invoice.dt)
+        sent = Invoice.verifactu_dt.isnot(None) & (Invoice.verifactu_err == 0)
+        return db.session.query(
+            Invoice.company_id.label('company_id'),
+            year.label('year'),
+            month.label('month'),
+            Invoice.verifactu_type.label('verifactu_type'),
+            InvoiceVatTotal.vat.label('vat'),
+            db.func.count().label('invoices'),
+            db.func.sum(InvoiceVatTotal.bi).label('bi'),
+            db.func.sum(InvoiceVatTotal.tvat).label('tvat'),
+            db.func.sum(db.case((Invoice.voided, 1), else_=0)).label('voided'),
+            db.func.sum(db.case((Invoice.voided, InvoiceVatTotal.bi), else_=0)).label('voided_bi'),
+            db.func.sum(db.case((Invoice.voided, InvoiceVatTotal.tvat), else_=0)).label('voided_tvat'),
+            db.func.sum(db.case((sent, 1), else_=0)).label('sent')
+        ).join(InvoiceVatTotal, InvoiceVatTotal.invoice_id == Invoice.id).filter(*filters).group_by(
+            Invoice.company_id, year, month, Invoice.verifactu_type, InvoiceVatTotal.vat)
+
+    @staticmethod
+    def backfill():
+        if db.session.query(VatRollup).first() is None:
+            try:
+                db.session.execute(db.insert(VatRollup).from_select(VatRollup.keys + VatRollup.counters, VatRollup.compute()))
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+
+    @staticmethod
+    def months(period, num=0):
+        size = 12 // VatRollup.periods[period]
+        return ((num - 1) * size + 1, num * size) if num else (1, 12)
+
+    @staticmethod
+    def summarize(rows, period):
+        size = 12 // VatRollup.periods[period]
+        data = {}
+        for row in rows:
+            num = (int(row.month) - 1) // size + 1
+            label = {'month': f'{int(row.year)}-{int(row.month):02d}', 'quarter': f'{int(row.year)}-Q{num}', 'year': str(int(row.year))}[period]
+            item = data.setdefault((label, row.verifactu_type, row.vat), {
+                'period': label, 'verifactu_type': row.verifactu_type, 'vat': row.vat, **{k: 0 for k in VatRollup.counters}})
+            for k in VatRollup.counters:
+                item[k] += getattr(row, k) or 0
+
+        for item in data.values():
+            for k in ['bi', 'tvat', 'voided_bi', 'voided_tvat']:
+                item[k] = round(float(item[k]), 2)
+        return [data[key] for key in sorted(data)]
+
+    @staticmethod
+    def report(company_id, year, period, num=0, verify=False):
+        first, last = VatRollup.months(period, num)
+        rows = db.session.query(VatRollup).filter(
+            VatRollup.company_id == company_id,
+            VatRollup.year == year,
+            VatRollup.month.between(first, last)
+        ).all()
+        ret = {'data': VatRollup.summarize(rows, period)}
+
+        if verify:
+            computed = VatRollup.summarize(VatRollup.compute(
+                Invoice.company_id == company_id,
+                db.extract('year', Invoice.dt) == year,
+                db.extract('month', Invoice.dt).between(first, last)
+            ).all(), period)
+            rollup = {(item['period'], item['verifactu_type'], item['vat']): item for item in ret['data']}
+            computed = {(item['period'], item['verifactu_type'], item['vat']): item for item in computed}
+            differences = [{'rollup': rollup.get(key), 'computed': computed.get(key)}
+                           for key in sorted(set(rollup) | set(computed)) if rollup.get(key) != computed.get(key)]
+            ret['verify'] = {'ok': not differences, 'differences': differences}
+
+        return ret
+
+
+class SubmissionBatch(db.Model):
+    __tablename__ = 'submission_batches'
+    id = db.Column(INTEGER(unsigned=True), primary_key=True, autoincrement=True)
+    company_id = db.Column(INTEGER(unsigned=True), db.ForeignKey('companies.id', ondelete='CASCADE'), index=True, nullable=False)
+    created = db.Column(db.DateTime, nullable=False)
+    voided = db.Column(db.Boolean, nullable=False, default=False, server_default='0')
+    invoice_ids = db.Column(db.Text, nullable=False)
+    last_id = db.Column(INTEGER(unsigned=True), db.ForeignKey('invoices.id', ondelete='CASCADE'))
+    dt = db.Column(db.String(25), nullable=False)
+    payload = db.Column(db.LargeBinary(length=16777215), nullable=False)
+
+    def __repr__(self):
+        return f'<SubmissionBatch {self.id}>'
+
+
+class Worker(db.Model):
+    __tablename__ = 'workers'
+    id = db.Column(db.String(100), primary_key=True)
+    heartbeat = db.Column(db.DateTime, index=True, nullable=False)
+
+    def __repr__(self):
+        return f'<Worker {self.id}>'
+
+    @staticmethod
+    def beat(id):
+        now = db_now()
+        if not db.session.query(Worker).filter_by(id=id).update({'heartbeat': now}, synchronize_session=False):
+            db.session.add(Worker(id=id, heartbeat=now))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+
+    @staticmethod
+    def active(ttl):
+        db.session.query(Worker).filter(Worker.heartbeat < db_now() - timedelta(seconds=ttl)).delete()
+        db.session.commit()
+        return db.session.query(db.func.count(Worker.id)).scalar()
+
+    @staticmethod
+    def release(id):
+        db.session.query(Worker).filter_by(id=id).delete()
+        db.session.commit()
+
+
+class CompanyLease(db.Model):
+    __tablename__ = 'company_leases'
+    company_id = db.Column(INTEGER(unsigned=True), db.ForeignKey('companies.id', ondelete='CASCADE'), primary_key=True)
+    owner = db.Column(db.String(100), index=True, nullable=False)
+    expires = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<CompanyLease {self.company_id} {self.owner}>'
+
+    @staticmethod
+    def acquire(company_id, owner, ttl, limit=None):
+        now = db_now()
+        if limit is not None:
+            owned = {row.company_id for row in db.session.query(CompanyLease.company_id).filter(CompanyLease.owner == owner, CompanyLease.expires >= now)}
+            if company_id in owned and len(owned) > limit:
+                CompanyLease.release(company_id, owner)
+                return False
+            if company_id not in owned and len(owned) >= limit:
+                return False
+
+        expires = now + timedelta(seconds=ttl)
+        if not db.session.query(CompanyLease).filter(
+            CompanyLease.company_id == company_id,
+            db.or_(CompanyLease.owner == owner, CompanyLease.expires < now)
+        ).update({'owner': owner, 'expires': expires}, synchronize_session=False):
+            db.session.add(CompanyLease(company_id=company_id, owner=owner, expires=expires))
+        try:
+            db.session.commit()
+            return True
+        except IntegrityError:
+            db.session.rollback()
+            return False
+
+    @staticmethod
+    def release(company_id, owner):
+        db.session.query(CompanyLease).filter_by(company_id=company_id, owner=owner).delete()
+        db.session.commit()
+
+    @staticmethod
+    def release_all(owner):
+        db.session.query(CompanyLease).filter_by(owner=owner).delete()
+        db.session.commit()
+
+
+class CompanyLock(db.Model):
+    __tablename__ = 'company_locks'
+    company_id = db.Column(INTEGER(unsigned=True), db.ForeignKey('companies.id', ondelete='CASCADE'), primary_key=True)
+    owner = db.Column(db.String(100), nullable=False)
+    expires = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<CompanyLock {self.company_id} {self.owner}>'
+
+    @staticmethod
+    def acquire(company_id, owner, ttl):
+        now = db_now()
+        db.session.query(CompanyLock).filter(CompanyLock.company_id == company_id, CompanyLock.expires < now).delete()
+        db.session.add(CompanyLock(company_id=company_id, owner=owner, expires=now + timedelta(seconds=ttl)))
+        try:
+            db.session.commit()
+            return True
+        except IntegrityError:
+            db.session.rollback()
+            return False
+
+    @staticmethod
+    def renew(company_id, owner, ttl):
+        renewed = db.session.query(CompanyLock).filter_by(company_id=company_id, owner=owner).update(
+            {'expires': db_now() + timedelta(seconds=ttl)}, synchronize_session=False)
+        db.session.commit()
+        return renewed > 0
+
+    @staticmethod
+    def release(company_id, owner):
+        db.session.query(CompanyLock).filter_by(company_id=company_id, owner=owner).delete()
+        db.session.commit()
+
+
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+    id = db.Column(INTEGER(unsigned=True), primary_key=True, autoincrement=True)
+    company_id = db.Column(INTEGER(unsigned=True), db.ForeignKey('companies.id', ondelete='CASCADE'), nullable=False)
+    key = db.Column(db.String(100), nullable=False)
+    request_hash = db.Column(db.String(64), nullable=False)
+    invoice_id = db.Column(INTEGER(unsigned=True), db.ForeignKey('invoices.id', ondelete='CASCADE'))
+    claimed = db.Column(db.DateTime, nullable=False)
+    expires = db.Column(db.DateTime, index=True, nullable=False)
+
+    __table_args__ = (db.UniqueConstraint('company_id', 'key'),)
+
+    def __repr__(self):
+        return f'<IdempotencyKey {self.key}>'
+
+    @staticmethod
+    def claim(company_id, key, request_hash, ttl, stale=60):
+        now = db_now()
+        db.session.query(IdempotencyKey).filter(IdempotencyKey.expires < now).delete()
+
+        idempotency = IdempotencyKey(company_id=company_id, key=key, request_hash=request_hash, claimed=now, expires=now + timedelta(seconds=ttl))
+        db.session.add(idempotency)
+        try:
+            db.session.commit()
+            return idempotency.id, None
+        except IntegrityError:
+            db.session.rollback()
+
+        row = db.session.query(IdempotencyKey).filter_by(company_id=company_id, key=key).first()
+        if row is None:
+            return jsonify({'error': 'Request with same Idempotency-Key in progress'}), HTTPStatus.CONFLICT
+        if row.request_hash != request_hash:
+            return jsonify({'error': 'Idempotency-Key already used with a different request'}), HTTPStatus.UNPROCESSABLE_ENTITY
+        if row.invoice_id:
+            return jsonify({'id': row.invoice_id}), HTTPStatus.CREATED
+
+        # Claim left by a request that crashed, taken over by the retry
+        if row.claimed < now - timedelta(seconds=stale) and db.session.query(IdempotencyKey).filter(
+            IdempotencyKey.id == row.id, IdempotencyKey.invoice_id.is_(None), IdempotencyKey.claimed == row.claimed
+        ).update({'claimed': now, 'expires': now + timedelta(seconds=ttl)}, synchronize_session=False):
+            db.session.commit()
+            return row.id, None
+        db.session.rollback()
+        return jsonify({'error': 'Request with same Idempotency-Key in progress'}), HTTPStatus.CONFLICT
+
+    @staticmethod
+    def complete(id, invoice_id):
+        if id:
+            db.session.query(IdempotencyKey).filter_by(id=id).update({'invoice_id': invoice_id})
+            db.session.commit()
+
+    @staticmethod
+    def release(id):
+        if id:
+            db.session.rollback()
+            db.session.query(IdempotencyKey).filter_by(id=id).delete()
+            db.session.commit()
+
+
+class InvoiceRecord:
+    __slots__ = ('id', 'dt', 'num', 'name', 'vat_id', 'bi', 'tvat', 'total', 'comments', 'fingerprint', 'verifactu_type',
+                 'verifactu_stype', 'verifactu_dt', 'verifactu_csv', 'verifactu_err', 'invoice_ref_id', 'number_format')
+    fields = __slots__[:-1]
+
+    def __init__(self, company, row):
+        for field in self.fields:
+            setattr(self, field, getattr(row, field))
+        self.number_format = number_format(company, self.verifactu_type, self.num, self.dt)
+
+    def __repr__(self):
+        return f'<InvoiceRecord {self.id}>'
+
+    def get_number_format(self):
+        return self.number_format
+
+    @staticmethod
+    def select(company, *filters, order_by=None, limit=None):
+        query = db.session.query(*[getattr(Invoice, field) for field in InvoiceRecord.fields]).filter(Invoice.company_id == company.id, *filters)
+        if order_by is not None:
+            query = query.order_by(*order_by) if isinstance(order_by, (list, tuple)) else query.order_by(order_by)
+        if limit:
+            query = query.limit(limit)
+        return [InvoiceRecord(company, row) for row in query.all()]
+
+
+def invoice_version(id, verifactu_dt, verifactu_err, voided, fingerprint, verifactu_csv, local_error):
+    version = f'{id}|{verifactu_dt}|{verifactu_err}|{bool(voided)}|{fingerprint}|{verifactu_csv}|{local_error}'
+    return hashlib.sha1(version.encode()).hexdigest()
+
+
+def number_format(company, verifactu_type, num, dt):
+    f = 'formula' if not verifactu_type or verifactu_type[0] == 'F' else 'formula_r'
+    formula = getattr(company, f, None) or ('%n%' if verifactu_type[0] == 'F' else 'R-%n%')
+    return re.sub(r'%n(?:\.(\d+))?%',
+        lambda m: f'{num:0{int(m.group(1))}d}' if m.group(1) else str(num),
+        formula.replace('%y%', dt.strftime('%y')).replace('%Y%', dt.strftime('%Y')))
+
+
+def db_now():
+    # Leases and heartbeats use the database clock so nodes with skewed clocks agree (SQLite returns it as text)
+    now = db.session.query(db.func.now()).scalar()
+    return datetime.fromisoformat(now) if isinstance(now, str) else now
+
+
 def to_dict(obj):
     return {k: (v.to_dict() if hasattr(v, '__tablename__') else v) for k, v in vars(obj).items() if not k.startswith('_')}
 
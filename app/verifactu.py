@@ -7,17 +7,49 @@ import os
 import re
 import ssl
 import sys
+import math
+import time
+import zlib
+import socket
+import threading
 import hashlib
 import configparser
 import urllib.request
 import xml.etree.ElementTree as ET
 
-from datetime import datetime
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+from datetime import datetime, timedelta
 from sqlalchemy import desc, update
 from configparser import UNNAMED_SECTION
 
 from app import db, config_file, time_zone
-from .models import Company, Invoice, InvoiceLine
+from .models import Company, Invoice, InvoiceLine, InvoiceRecord, InvoiceVatTotal, VatRollup, SubmissionBatch, Worker, CompanyLease, CompanyLock, InvoiceError, db_now
+
+
+schemas = {}
+xsd_urls = [
+    'https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aplicaciones/es/aeat/tike/cont/ws/SuministroLR.xsd',
+    'https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aplicaciones/es/aeat/tike/cont/ws/SuministroInformacion.xsd',
+    'https://www.w3.org/TR/xmldsig-core/xmldsig-core-schema.xsd'
+]
+
+
+if etree is not None:
+    class LocalResolver(etree.Resolver):
+        # Imported schemas (SuministroInformacion, xmldsig) read from verifactu_xsd_path instead of the network
+        def __init__(self, path):
+            super().__init__()
+            self.path = path
+
+        def resolve(self, url, pubid, context):
+            file_path = os.path.join(self.path, os.path.basename(url))
+            if os.path.isfile(file_path):
+                return self.resolve_filename(file_path, context)
+            return None
 
 
 class verifactuXML:
@@ -27,6 +59,13 @@ class verifactuXML:
 
         self.log_file = config.get(UNNAMED_SECTION, 'verifactu_log_file', fallback='')
         self.save_responses = config.get(UNNAMED_SECTION, 'verifactu_save_responses', fallback='')
+        self.xsd_path = config.get(UNNAMED_SECTION, 'verifactu_xsd_path', fallback='')
+        self.batch_max_age = config.getint(UNNAMED_SECTION, 'verifactu_batch_max_age', fallback=3600)
+        self.worker_id = config.get(UNNAMED_SECTION, 'worker_id', fallback='') or socket.gethostname()
+        self.lock_owner = f'{self.worker_id}-{os.getpid()}-{threading.get_ident()}'
+        self.lease_ttl = config.getint(UNNAMED_SECTION, 'worker_lease_ttl', fallback=300)
+        self.lock_wait = config.getint(UNNAMED_SECTION, 'worker_lock_wait', fallback=60)
+        self.timeout = config.getint(UNNAMED_SECTION, 'verifactu_timeout', fallback=120)
         self.software_company_name = config.get(UNNAMED_SECTION, 'software_company_name', fallback='')
         self.software_company_nif = config.get(UNNAMED_SECTION, 'software_company_nif', fallback='')
         self.software_name = config.get(UNNAMED_SECTION, 'software_name', fallback='')
@@ -36,6 +75,8 @@ class verifactuXML:
 
         self.url_prod = 'https://www1.agenciatributaria.gob.es/wlpl/TIKE-CONT/ws/SistemaFacturacion/VerifactuSOAP'
         self.url_test = 'https://prewww1.aeat.es/wlpl/TIKE-CONT/ws/SistemaFacturacion/VerifactuSOAP'
+        self.ns_sum = 'https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aplicaciones/es/aeat/tike/cont/ws/SuministroLR.xsd'
+        self.ns_si = 'https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aplicaciones/es/aeat/tike/cont/ws/SuministroInformacion.xsd'
 
         if not self.software_company_name or not self.software_company_nif or not self.software_name or not self.software_id or not self.software_version or not self.software_install_number:
             sys.exit('Software info not found')
@@ -68,10 +109,9 @@ class verifactuXML:
         return now.strftime(f"%Y-%m-%dT%H:%M:%S{('+%02d:00' % offset) if offset >= 0 else ('%02d:00' % offset)}")
 
     def last_invoice(self, company):
-        return db.session.query(Invoice).filter(
-            Invoice.company_id == company.id,
-            Invoice.fingerprint.isnot(None)
-        ).order_by(desc(Invoice.verifactu_dt), desc(Invoice.id)).first()
+        records = InvoiceRecord.select(company, Invoice.fingerprint.isnot(None),
+                                       order_by=(desc(Invoice.verifactu_dt), desc(Invoice.id)), limit=1)
+        return records[0] if records else None
 
     def fingerprint(self, company, invoice, last, dt, voided=False):
         last_fp = last.fingerprint if last is not None else ''
@@ -87,8 +127,7 @@ class verifactuXML:
 
     def registro_alta(self, company, invoice, last, dt):
         if not invoice.comments:
-            line = db.session.query(InvoiceLine).filter(InvoiceLine.invoice_id == invoice.id).first()
-            descr = line.descr if line else 'Factura'
+            descr = db.session.query(InvoiceLine.descr).filter(InvoiceLine.invoice_id == invoice.id).order_by(InvoiceLine.num).limit(1).scalar() or 'Factura'
         else:
             descr = invoice.comments
 
@@ -108,7 +147,7 @@ class verifactuXML:
             if invoice.verifactu_stype:
                 xml += f'<TipoRectificativa>{"S" if invoice.verifactu_stype == "S" else "I"}</TipoRectificativa>'
 
-            rinvoices = db.session.query(Invoice).filter(Invoice.id == invoice.invoice_ref_id).order_by(Invoice.dt).all()
+            rinvoices = InvoiceRecord.select(company, Invoice.id == invoice.invoice_ref_id, order_by=Invoice.dt)
             if rinvoices:
                 xml += '<FacturasSustituidas>' if invoice.verifactu_type == 'F3' else '<FacturasRectificadas>'
                 tag = 'IDFacturaSustituida' if invoice.verifactu_type == 'F3' else 'IDFacturaRectificada'
@@ -122,15 +161,8 @@ class verifactuXML:
                 bi_total = 0.0
                 tvat_total = 0.0
                 for rinvoice in rinvoices:
-                    totals = (
-                        db.session.query(
-                            db.func.sum(InvoiceLine.bi).label('bi'),
-                            db.func.sum(InvoiceLine.tvat).label('tvat')
-                        ).filter(InvoiceLine.invoice_id == rinvoice.id).first()
-                    )
-                    if totals:
-                        bi_total += float(totals.bi or 0)
-                        tvat_total += float(totals.tvat or 0)
+                    bi_total += float(rinvoice.bi or 0)
+                    tvat_total += float(rinvoice.tvat or 0)
                 xml += f'<ImporteRectificacion><BaseRectificada>{self.cur(bi_total)}</BaseRectificada>'
                 xml += f'<CuotaRectificada>{self.cur(tvat_total)}</CuotaRectificada></ImporteRectificacion>'
 
@@ -143,11 +175,7 @@ class verifactuXML:
             xml += f'<NIF>{invoice.vat_id}</NIF></IDDestinatario></Destinatarios>'
 
         xml += f'<Desglose>'
-        lines = db.session.query(
-            db.func.sum(InvoiceLine.bi).label('bi'),
-            db.func.sum(InvoiceLine.tvat).label('tvat'),
-            InvoiceLine.vat
-        ).filter(InvoiceLine.invoice_id == invoice.id).group_by(InvoiceLine.vat).all()
+        lines = db.session.query(InvoiceVatTotal).filter(InvoiceVatTotal.invoice_id == invoice.id).order_by(InvoiceVatTotal.vat).all()
         for line in lines:
             xml += f'<DetalleDesglose><Impuesto>01</Impuesto>'
             if line.vat:
@@ -227,65 +255,173 @@ class verifactuXML:
                         <IndicadorMultiplesOT>S</IndicadorMultiplesOT>
                    </SistemaInformatico>"""
 
+    def schema(self):
+        file_path = os.path.join(self.xsd_path, 'SuministroLR.xsd') if self.xsd_path else ''
+        if file_path not in schemas:
+            schemas[file_path] = None
+            if etree is None:
+                self.log('XSD validation disabled: lxml not installed')
+            elif not file_path:
+                self.log('XSD validation disabled: no verifactu_xsd_path')
+            else:
+                try:
+                    parser = etree.XMLParser()
+                    parser.resolvers.add(LocalResolver(self.xsd_path))
+                    schemas[file_path] = etree.XMLSchema(etree.parse(file_path, parser))
+                except (OSError, etree.XMLSchemaParseError, etree.XMLSyntaxError) as e:
+                    self.log(f'XSD validation disabled: {str(e)}')
+        return schemas[file_path]
+
+    def validate(self, cabecera, registro):
+        schema = self.schema()
+        if schema is None:
+            return None
+
+        xml = f'<sum:RegFactuSistemaFacturacion xmlns:sum="{self.ns_sum}" xmlns="{self.ns_si}">{cabecera}{registro}</sum:RegFactuSistemaFacturacion>'
+        try:
+            doc = etree.fromstring(re.sub(r'>\s+<', '><', xml).encode('utf-8'))
+        except etree.XMLSyntaxError as e:
+            return str(e)
+
+        if schema.validate(doc):
+            return None
+        return schema.error_log.last_error.message
+
+    def store_batch(self, company, voided, last_map, dt, xml):
+        ids = list(last_map)
+        last = last_map[ids[0]]
+        batch = SubmissionBatch(company_id=company.id, created=datetime.now(), voided=voided, invoice_ids=','.join(map(str, ids)),
+                                last_id=last.id if last else None, dt=dt, payload=zlib.compress(xml.encode('utf-8')))
+        db.session.add(batch)
+        db.session.commit()
+        return batch.id
+
+    def load_batch(self, company, voided, pending=None):
+        batch = db.session.query(SubmissionBatch).filter_by(company_id=company.id, voided=voided).order_by(desc(SubmissionBatch.id)).first()
+        if batch is None:
+            return None
+
+        ids = [int(i) for i in batch.invoice_ids.split(',')]
+        unsent = Invoice.voided.is_(False) if voided else Invoice.verifactu_dt.is_(None)
+        records = {record.id: record for record in InvoiceRecord.select(company, Invoice.id.in_(ids), unsent)}
+        last = self.last_invoice(company)
+
+        if (datetime.now() - batch.created).total_seconds() > self.batch_max_age or len(records) != len(ids) or (last.id if last else None) != batch.last_id or\
+           (pending is not None and not set(ids) <= set(pending)):
+            self.log(f'Batch {batch.id} discarded, rebuilding')
+            self.delete_batch(batch.id)
+            return None
+
+        invoices = [records[id] for id in ids]
+        last_map = {}
+        for invoice in invoices:
+            invoice.fingerprint = self.fingerprint(company, invoice, last, batch.dt, voided)
+            last_map[invoice.id] = last
+            last = invoice
+
+        self.log(f'Batch {batch.id} resent')
+        return batch.id, invoices, last_map, batch.dt, zlib.decompress(batch.payload).decode('utf-8')
+
+    def delete_batch(self, id):
+        db.session.query(SubmissionBatch).filter_by(id=id).delete()
+        db.session.commit()
+
     def pending(self):
         resp = {'companies': {}}
 
-        companies = db.session.query(Company,
-            (db.func.unix_timestamp(Company.next_send) - db.func.unix_timestamp(db.func.now())).label('nxSend')
-        ).all()
+        companies = db.session.query(Company).all()
 
-        for company, nx_send in companies:
-            resp['companies'][company.id] = {}
+        Worker.beat(self.worker_id)
+        limit = math.ceil(len(companies) / max(1, Worker.active(self.lease_ttl)))
 
-            if nx_send and nx_send > 0:
-                resp['companies'][company.id]['message'] = f'Next send in {nx_send} seconds'
-            else:
-                invoices = db.session.query(Invoice).filter(
-                    Invoice.company_id == company.id,
-                    Invoice.verifactu_dt.is_(None)
-                ).order_by(Invoice.dt).limit(1000).all()
-                resp['companies'][company.id] = self.send(company, invoices)
+        try:
+            for company in companies:
+                resp['companies'][company.id] = {}
+                now = db_now()
+                nx_send = math.ceil((company.next_send - now).total_seconds()) if company.next_send else 0
+
+                if not CompanyLease.acquire(company.id, self.worker_id, self.lease_ttl, limit):
+                    resp['companies'][company.id]['message'] = 'Processed by another worker'
+                elif nx_send > 0:
+                    resp['companies'][company.id]['message'] = f'Next send in {nx_send} seconds'
+                elif not self.lock(company):
+                    resp['companies'][company.id]['message'] = 'Sending by another worker'
+                else:
+                    try:
+                        invoices = InvoiceRecord.select(company, Invoice.verifactu_dt.is_(None), order_by=Invoice.dt, limit=1000)
+                        resp['companies'][company.id] = self.send(company, invoices)
+                    finally:
+                        CompanyLock.release(company.id, self.lock_owner)
+        finally:
+            # Each cron run is a new process, leave nothing behind for the next one
+            CompanyLease.release_all(self.worker_id)
+            Worker.release(self.worker_id)
 
         return resp
 
     def voided(self, company, invoices):
-        return self.send(company, invoices, True)
-
-    def send(self, company, invoices, voided=False):
-        if not invoices or len(invoices) == 0:
-            return {'message': 'No invoices to send'}
-
-        ikeys = {}
-        for key, invoice in enumerate(invoices):
-            ikeys[invoice.get_number_format()] = key
-
+        if not self.lock(company, self.lock_wait):
+            return {'error': 'Company sending by another worker, try again later'}
+        try:
+            ids = [invoice.id for invoice in invoices]
+            records = {record.id: record for record in InvoiceRecord.select(company, Invoice.id.in_(ids), Invoice.voided.is_(False))}
+            return self.send(company, [records[id] for id in ids if id in records], True)
+        finally:
+            CompanyLock.release(company.id, self.lock_owner)
+
+    def lock(self, company, wait=0):
+        end = time.monotonic() + wait
+        while not CompanyLock.acquire(company.id, self.lock_owner, self.lease_ttl):
+            if time.monotonic() >= end:
+                return False
+            time.sleep(0.5)
+        return True
+
+    def build(self, company, invoices, held, voided=False):
         dt = self.hour_timezone()
+        cabecera = f"""<sum:Cabecera>
+                            <ObligadoEmision>
+                                <NombreRazon>{company.name}</NombreRazon>
+                                <NIF>{self.cod(company.vat_id)}</NIF>
+                            </ObligadoEmision>
+                        </sum:Cabecera>"""
         xml = f"""<?xml version="1.0" encoding="UTF-8"?>
                     <soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/"
-                            xmlns:sum="https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aplicaciones/es/aeat/tike/cont/ws/SuministroLR.xsd"
-                            xmlns="https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aplicaciones/es/aeat/tike/cont/ws/SuministroInformacion.xsd">
+                            xmlns:sum="{self.ns_sum}"
+                            xmlns="{self.ns_si}">
                         <soapenv:Header/>
                         <soapenv:Body>
                             <sum:RegFactuSistemaFacturacion>
-                                <sum:Cabecera>
-                                    <ObligadoEmision>
-                                        <NombreRazon>{company.name}</NombreRazon>
-                                        <NIF>{self.cod(company.vat_id)}</NIF>
-                                    </ObligadoEmision>
-                                </sum:Cabecera>"""
+                                {cabecera}"""
 
         last_map = {}
         last = self.last_invoice(company)
 
         for invoice in invoices:
-            invoice.fingerprint = self.fingerprint(company, invoice, last, dt, voided)
-            last_map[invoice.id] = last
             if voided:
-                xml += self.registro_anulacion(company, invoice, last, dt)
+                registro = self.registro_anulacion(company, invoice, last, dt)
             else:
-                xml += self.registro_alta(company, invoice, last, dt)
+                registro = self.registro_alta(company, invoice, last, dt)
+
+            error = self.validate(cabecera, registro)
+            if error:
+                held.append({'id': invoice.id, 'num': invoice.get_number_format(), 'codError': 'XSD', 'descrError': error})
+                db.session.merge(InvoiceError(invoice_id=invoice.id, created=datetime.now(), error=f'XSD {error}'))
+                db.session.commit()
+                self.log(f'XSD error NumSerieFactura={invoice.get_number_format()} {error}')
+                continue
+
+            invoice.fingerprint = self.fingerprint(company, invoice, last, dt, voided)
+            last_map[invoice.id] = last
+            xml += registro
             last = invoice
 
+        if not last_map:
+            return None, last_map, dt, xml
+
+        # Records held in a previous run that validate now
+        db.session.query(InvoiceError).filter(InvoiceError.invoice_id.in_(list(last_map))).delete(synchronize_session=False)
+
         xml += '''    </sum:RegFactuSistemaFacturacion>
                     </soapenv:Body>
                 </soapenv:Envelope>'''
@@ -295,7 +431,52 @@ class verifactuXML:
             with open(file_path, 'w', encoding='utf-8') as f:
                 f.write(xml)
 
+        return self.store_batch(company, voided, last_map, dt, xml), last_map, dt, xml
+
+    def send(self, company, invoices, voided=False):
+        if not invoices or len(invoices) == 0:
+            return {'message': 'No invoices to send'}
+
+        # Voids are requested by users, so a stored batch from a previous request is resent first and the new one after it
+        batch = self.load_batch(company, voided, None if voided else [invoice.id for invoice in invoices])
+        if batch:
+            ret = self.post(company, *batch, [], voided)
+            if not voided or 'ok' not in ret:
+                return ret
+            resent = {invoice.id for invoice in batch[1]}
+            invoices = [invoice for invoice in invoices if invoice.id not in resent]
+            if not invoices:
+                return ret
+        else:
+            ret = {'ok': [], 'ko': []}
+
+        held = []
+        batch_id, last_map, dt, xml = self.build(company, invoices, held, voided)
+        if not last_map:
+            return {'ok': ret['ok'], 'ko': ret['ko'] + held}
+
+        new = self.post(company, batch_id, invoices, last_map, dt, xml, held, voided)
+        if not ret['ok'] and not ret['ko']:
+            return new
+        if 'ok' not in new:
+            return {**new, **ret}
+        return {'ok': ret['ok'] + new['ok'], 'ko': ret['ko'] + new['ko']}
+
+    def post(self, company, batch_id, invoices, last_map, dt, xml, held, voided=False):
+        ikeys = {}
+        for key, invoice in enumerate(invoices):
+            ikeys[invoice.get_number_format()] = key
+
+        Worker.beat(self.worker_id)
+        if not CompanyLock.renew(company.id, self.lock_owner, self.lease_ttl):
+            self.log(f'Lock lost for company {company.id}, batch {batch_id} kept')
+            return {'error': 'Lock lost, try again later', 'retry': True}
+
         ret = self.send_xml(company, xml)
+        if ret.get('retry'):
+            return ret
+
+        self.delete_batch(batch_id)
         if ret.get('status') != 200 or ret.get('error'):
             return ret
 
@@ -317,13 +498,13 @@ class verifactuXML:
             self.log(f'XML error={str(e)}')
             return {'error': f'XML error={str(e)}'}
 
-        ret = {'ok': [], 'ko': []}
+        ret = {'ok': [], 'ko': held}
         csv = self.get_text(body.find(f'.//{{{namespaces["tikR"]}}}CSV'))
         tiempo_espera_envio = self.get_text(body.find(f'.//{{{namespaces["tikR"]}}}TiempoEsperaEnvio'))
         timestamp_presentacion = self.get_text(body.find(f'.//{{{namespaces["tikR"]}}}DatosPresentacion/{{{namespaces["tik"]}}}TimestampPresentacion'))
 
         db.session.query(Company).filter_by(id=company.id).update({
-            'next_send': db.func.DATE_ADD(db.func.NOW(), db.text(f"INTERVAL {tiempo_espera_envio} SECOND"))
+            'next_send': db_now() + timedelta(seconds=int(tiempo_espera_envio or 0))
         })
         db.session.commit()
 
@@ -338,8 +519,9 @@ class verifactuXML:
                 continue
             invoice = invoices[index]
 
+            # Timestamp with offset, bound as text so the database converts it as before
             stmt = update(Invoice).where(Invoice.id == invoice.id).values({
-                'verifactu_dt': timestamp_presentacion if timestamp_presentacion else dt,
+                'verifactu_dt': db.literal(timestamp_presentacion if timestamp_presentacion else dt, db.String),
                 'verifactu_err': cod_error
             })
             if csv:
@@ -350,6 +532,17 @@ class verifactuXML:
             if not cod_error and voided:
                 stmt = stmt.values({'voided': 1})
             db.session.execute(stmt)
+            if not cod_error:
+                db.session.query(InvoiceError).filter_by(invoice_id=invoice.id).delete()
+
+            # sent counts records with verifactu_dt and no error, as VatRollup.compute, so a void can also change it
+            was_sent = invoice.verifactu_dt is not None and invoice.verifactu_err == 0
+            if (not cod_error and voided) or (not cod_error) != was_sent:
+                totals = db.session.query(InvoiceVatTotal.vat, InvoiceVatTotal.bi, InvoiceVatTotal.tvat).filter(InvoiceVatTotal.invoice_id == invoice.id).all()
+                if not cod_error and voided:
+                    VatRollup.add(company.id, invoice.dt, invoice.verifactu_type, totals, voided=True)
+                if (not cod_error) != was_sent:
+                    VatRollup.add(company.id, invoice.dt, invoice.verifactu_type, totals, sent=-1 if was_sent else 1)
             db.session.commit()
 
             if cod_error:
@@ -441,11 +634,66 @@ class verifactuXML:
 
         return {'data': data}
 
+    def verify_chain(self, company, year=0, month=0):
+        ret = self.consulta(company, year, month)
+        if 'data' not in ret:
+            return ret
+
+        regs = []
+        for reg in ret['data']:
+            idf = reg.get('IDFactura') or {}
+            data = reg.get('DatosRegistroFacturacion') or {}
+            if not data.get('Huella'):
+                continue
+            prev = (data.get('Encadenamiento') or {}).get('RegistroAnterior') or {}
+            if data.get('TipoFactura'):
+                f = (f"IDEmisorFactura={idf.get('IDEmisorFactura')}&NumSerieFactura={idf.get('NumSerieFactura')}"
+                f"&FechaExpedicionFactura={idf.get('FechaExpedicionFactura')}&TipoFactura={data.get('TipoFactura')}"
+                f"&CuotaTotal={self.cur(data.get('CuotaTotal') or 0)}&ImporteTotal={self.cur(data.get('ImporteTotal') or 0)}"
+                f"&Huella={prev.get('Huella', '')}&FechaHoraHusoGenRegistro={data.get('FechaHoraHusoGenRegistro')}")
+            else:
+                # Anulación, part of the chain as well
+                f = (f"IDEmisorFacturaAnulada={idf.get('IDEmisorFactura')}&NumSerieFacturaAnulada={idf.get('NumSerieFactura')}"
+                f"&FechaExpedicionFacturaAnulada={idf.get('FechaExpedicionFactura')}"
+                f"&Huella={prev.get('Huella', '')}&FechaHoraHusoGenRegistro={data.get('FechaHoraHusoGenRegistro')}")
+            regs.append((data.get('FechaHoraHusoGenRegistro'), idf.get('NumSerieFactura'), data.get('Huella'), prev.get('Huella'),
+                         hashlib.sha256(f.encode()).hexdigest().upper()))
+
+        errors = []
+        fingerprints = {reg[2] for reg in regs}
+        # Links to records outside the queried period are checked against the local chain
+        missing = {reg[3] for reg in regs if reg[3] and reg[3] not in fingerprints}
+        if missing:
+            fingerprints |= {fp for fp, in db.session.query(Invoice.fingerprint).filter(Invoice.company_id == company.id, Invoice.fingerprint.in_(missing))}
+        for key, (dt, num, fp, prev_fp, calc_fp) in enumerate(sorted(regs)):
+            if fp != calc_fp:
+                errors.append({'num': num, 'error': 'Huella', 'huella': fp, 'calculated': calc_fp})
+            if key and prev_fp not in fingerprints:
+                errors.append({'num': num, 'error': 'Encadenamiento', 'huella': prev_fp})
+
+        return {'records': len(regs), 'ok': not errors, 'errors': errors}
+
+    def stats(self):
+        sent = Invoice.verifactu_dt.isnot(None) & (Invoice.verifactu_err == 0)
+        rows = db.session.query(
+            Company.id, Company.name, Company.next_send,
+            db.func.count(Invoice.id).label('invoices'),
+            db.func.sum(db.case((Invoice.verifactu_dt.is_(None), 1), else_=0)).label('pending'),
+            db.func.sum(db.case((sent, 1), else_=0)).label('sent'),
+            db.func.sum(db.case((Invoice.verifactu_err > 0, 1), else_=0)).label('errors'),
+            db.func.sum(db.case((Invoice.voided, 1), else_=0)).label('voided')
+        ).outerjoin(Invoice, Invoice.company_id == Company.id).group_by(Company.id, Company.name, Company.next_send).all()
+
+        return {row.id: {'name': row.name, 'next_send': row.next_send.strftime('%Y-%m-%d %H:%M:%S') if row.next_send else None,
+                         'invoices': row.invoices, 'pending': int(row.pending or 0), 'sent': int(row.sent or 0),
+                         'errors': int(row.errors or 0), 'voided': int(row.voided or 0)} for row in rows}
+
     def dtnow(self):
         return datetime.now().strftime('%Y%m%d%H%M%S')
 
     def send_xml(self, company, xml, log=True):
         error = None
+        retry = False
         xml = re.sub(r'>\s+<', '><', re.sub(r'\s*xmlns', ' xmlns', xml))
 
         url = self.url_test if company.test == 1 else self.url_prod
@@ -454,11 +702,16 @@ class verifactuXML:
         req = urllib.request.Request(url, data=xml.encode('utf-8'), headers={'Content-Type': 'text/xml'}, method='POST')
 
         try:
-            with urllib.request.urlopen(req, context=context) as response:
+            with urllib.request.urlopen(req, context=context, timeout=self.timeout) as response:
                 status = response.getcode()
                 response = response.read().decode('utf-8')
-        except urllib.error.URLError as e:
+        except urllib.error.HTTPError as e:
+            error = str(e)
+            status = e.code
+            response = ''
+        except (urllib.error.URLError, TimeoutError) as e:
             error = str(e)
+            retry = True
             status = 400
             response = ''
 
@@ -467,4 +720,7 @@ class verifactuXML:
             with open(filename, 'w', encoding='utf-8') as f:
                 f.write(response)
 
-        return {'status': status, 'response': response, 'error': error}
+        ret = {'status': status, 'response': response, 'error': error}
+        if retry:
+            ret['retry'] = True
+        return ret
@@ -0,0 +1,116 @@
+#
+# Veri*Factu - 2025 Eduardo Ruiz <eruiz@dataclick.es>
+# https://github.com/EduardoRuizM/verifactu-api-python
+#
+# Peak memory and time of verifactuXML.build (last_invoice, registros, fingerprints and stored batch) for a 1000 invoice batch
+# loaded as ORM Invoice instances vs slotted InvoiceRecord, and of last_invoice over the sent history
+# Usage: python benchmarks/bench_records.py [--uri sqlite://] [--records 1000] [--history 10000] [--rounds 5]
+#
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app, db
+from app.models import Company, Invoice, InvoiceLine, InvoiceRecord, SubmissionBatch
+import app.verifactu as verifactu
+
+
+def populate(records, history):
+    company = Company(name='Benchmark', vat_id='B00000000', created=datetime.now())
+    db.session.add(company)
+    db.session.commit()
+
+    sent = datetime(2025, 4, 1)
+    db.session.bulk_insert_mappings(Invoice, [
+        {'company_id': company.id, 'num': num, 'name': 'Cliente', 'vat_id': '00000000A', 'verifactu_type': 'F1', 'dt': sent,
+         'bi': 100.0, 'tvat': 21.0, 'total': 121.0, 'verifactu_dt': sent + timedelta(seconds=num), 'verifactu_err': 0, 'fingerprint': f'{num:064X}'}
+        for num in range(1, history + 1)])
+
+    for num in range(history + 1, history + records + 1):
+        invoice = Invoice(company_id=company.id, num=num, name='Cliente', vat_id='00000000A', verifactu_type='F1',
+                          dt=datetime(2025, 5, 1), bi=100.0, tvat=21.0, total=121.0)
+        db.session.add(invoice)
+        db.session.flush()
+        db.session.add(InvoiceLine(invoice_id=invoice.id, num=1, descr='Producto', units=1, price=100.0, vat=21, bi=100.0, tvat=21.0, total=121.0))
+    db.session.commit()
+    return company.id
+
+
+def orm(company, records):
+    return db.session.query(Invoice).filter(Invoice.company_id == company.id, Invoice.verifactu_dt.is_(None)).order_by(Invoice.dt).limit(records).all()
+
+
+def slotted(company, records):
+    return InvoiceRecord.select(company, Invoice.verifactu_dt.is_(None), order_by=Invoice.dt, limit=records)
+
+
+def measure(verifactuxml, load, company_id, records, rounds):
+    times = []
+    peak = 0
+    for _ in range(rounds):
+        db.session.expunge_all()
+        company = db.session.get(Company, company_id)
+        tracemalloc.start()
+        start = time.perf_counter()
+        batch_id, last_map, dt, xml = verifactuxml.build(company, load(company, records), [])
+        times.append(time.perf_counter() - start)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+        # build() commits the batch: with ORM instances the unsent fingerprints are flushed with it
+        persisted = db.session.query(Invoice).filter(Invoice.company_id == company_id, Invoice.verifactu_dt.is_(None), Invoice.fingerprint.isnot(None)).count()
+        db.session.query(Invoice).filter(Invoice.company_id == company_id, Invoice.verifactu_dt.is_(None)).update({'fingerprint': None})
+        db.session.query(SubmissionBatch).filter_by(id=batch_id).delete()
+        db.session.commit()
+    return min(times), peak, persisted
+
+
+def measure_last(verifactuxml, company_id, rounds):
+    company = db.session.get(Company, company_id)
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        verifactuxml.last_invoice(company)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--uri', default='sqlite://')
+    parser.add_argument('--records', type=int, default=1000)
+    parser.add_argument('--history', type=int, default=10000)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    # Software info required by verifactuXML, without XSD validation
+    with tempfile.NamedTemporaryFile('w', suffix='.conf', delete=False) as conf:
+        conf.write('software_company_name = Benchmark\nsoftware_company_nif = B00000000\nsoftware_name = Benchmark\nsoftware_id = vf\n')
+    verifactu.config_file = conf.name
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.uri
+    db.init_app(app)
+    try:
+        with app.app_context():
+            db.create_all()
+            company_id = populate(args.records, args.history)
+            verifactuxml = verifactu.verifactuXML()
+            for name, load in [('ORM Invoice', orm), ('InvoiceRecord', slotted)]:
+                seconds, peak, persisted = measure(verifactuxml, load, company_id, args.records, args.rounds)
+                print(f'build {name:<15} {args.records} records  time={seconds * 1000:8.2f} ms  peak={peak / 1024:9.1f} KiB  persisted={persisted}')
+            seconds = measure_last(verifactuxml, company_id, args.rounds)
+            print(f'last_invoice          {args.history} sent  time={seconds * 1000:8.2f} ms')
+    finally:
+        os.unlink(conf.name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#
+# Veri*Factu - 2025 Eduardo Ruiz <eruiz@dataclick.es>
+# https://github.com/EduardoRuizM/verifactu-api-python
+#
+
+import pytest
+
+from datetime import datetime
+
+from app import app as flask_app, db
+from app.models import Company
+
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    path = tmp_path_factory.mktemp('db')
+    flask_app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{path}/primary.db'
+    flask_app.config['SQLALCHEMY_BINDS'] = {'read': f'sqlite:///{path}/read.db'}
+    flask_app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'connect_args': {'timeout': 30, 'check_same_thread': False}}
+    flask_app.config['TESTING'] = True
+    db.init_app(flask_app)
+    with flask_app.app_context():
+        db.create_all()
+        db.metadata.create_all(db.engines['read'])
+    return flask_app
+
+
+@pytest.fixture
+def company(app):
+    with app.app_context():
+        company = Company(name=f'Test {datetime.now().timestamp()}', vat_id=f'B{datetime.now().timestamp()}', created=datetime.now())
+        db.session.add(company)
+        db.session.commit()
+        return company.id
+
+
+@pytest.fixture
+def verifactuxml(app, tmp_path, monkeypatch):
+    import app.verifactu as verifactu
+    conf = tmp_path / 'verifactu.conf'
+    conf.write_text('software_company_name = Test\nsoftware_company_nif = B00000000\nsoftware_name = Test\nsoftware_id = vf\n'
+                    f'verifactu_log_file = {tmp_path / "verifactu.log"}\nverifactu_xsd_path = {tmp_path}\n')
+    monkeypatch.setattr(verifactu, 'config_file', str(conf))
+    monkeypatch.setattr(verifactu, 'schemas', {})
+    return verifactu.verifactuXML
+
+
+@pytest.fixture
+def replicate(app):
+    def copy(*models):
+        with app.app_context():
+            with db.engines['read'].begin() as conn:
+                for model in models:
+                    table = model.__table__
+                    conn.execute(table.delete())
+                    rows = [dict(row) for row in db.session.execute(db.select(table)).mappings()]
+                    if rows:
+                        conn.execute(table.insert(), rows)
+    return copy
+
+
+def aeat_response(lines, wait=60, timestamp='2025-06-01T10:00:00+02:00'):
+    ns = 'https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aplicaciones/es/aeat/tike/cont/ws'
+    xml = ''
+    for num, error in lines:
+        xml += (f'<tikR:RespuestaLinea><tikR:IDFactura><tik:NumSerieFactura>{num}</tik:NumSerieFactura></tikR:IDFactura>'
+                f'<tikR:EstadoRegistro>{"Incorrecto" if error else "Correcto"}</tikR:EstadoRegistro>' +
+                (f'<tikR:CodigoErrorRegistro>{error}</tikR:CodigoErrorRegistro>' if error else '') + '</tikR:RespuestaLinea>')
+    return (f'<env:Envelope xmlns:env="http://schemas.xmlsoap.org/soap/envelope/" xmlns:tikR="{ns}/RespuestaSuministro.xsd" '
+            f'xmlns:tik="{ns}/SuministroInformacion.xsd"><env:Body><tikR:RespuestaRegFactuSistemaFacturacion>'
+            f'<tikR:CSV>A-TEST</tikR:CSV><tikR:DatosPresentacion><tik:TimestampPresentacion>{timestamp}</tik:TimestampPresentacion>'
+            f'</tikR:DatosPresentacion><tikR:TiempoEsperaEnvio>{wait}</tikR:TiempoEsperaEnvio>{xml}'
+            '</tikR:RespuestaRegFactuSistemaFacturacion></env:Body></env:Envelope>')
@@ -0,0 +1,61 @@
+#
+# Veri*Factu - 2025 Eduardo Ruiz <eruiz@dataclick.es>
+# https://github.com/EduardoRuizM/verifactu-api-python
+#
+
+from datetime import datetime
+
+from app import db
+from app.models import Company, CompanyLock, Invoice, InvoiceRecord, SubmissionBatch
+
+
+def invoices(company, count, **kwargs):
+    items = [Invoice(company_id=company, num=num, name='Cliente', verifactu_type='F2', dt=datetime(2025, 5, num), **kwargs)
+             for num in range(1, count + 1)]
+    db.session.add_all(items)
+    db.session.commit()
+    return [item.id for item in items]
+
+
+def records(company, ids):
+    return InvoiceRecord.select(company, Invoice.id.in_(ids), order_by=Invoice.id)
+
+
+def test_void_batch_is_resent_before_new_request(app, company, verifactuxml, monkeypatch):
+    with app.app_context():
+        ids = invoices(company, 2, verifactu_dt=datetime(2025, 5, 10), verifactu_err=0)
+        record = db.session.get(Company, company)
+        verifactu = verifactuxml()
+        posted = []
+
+        monkeypatch.setattr(verifactu, 'send_xml', lambda company, xml: {'status': 400, 'error': 'timeout', 'retry': True})
+        assert verifactu.voided(record, records(record, ids[:1])).get('error') == 'timeout'
+
+        def post(company, batch_id, invoices, last_map, dt, xml, held, voided=False):
+            posted.append(list(last_map))
+            verifactu.delete_batch(batch_id)
+            db.session.query(Invoice).filter(Invoice.id.in_(list(last_map))).update({'voided': True})
+            db.session.commit()
+            return {'ok': [{'id': id} for id in last_map], 'ko': held}
+
+        monkeypatch.setattr(verifactu, 'post', post)
+        ret = verifactu.voided(record, records(record, ids[1:]))
+
+        assert posted == [ids[:1], ids[1:]]
+        assert [item['id'] for item in ret['ok']] == ids
+        assert db.session.query(SubmissionBatch).filter_by(company_id=company).count() == 0
+
+
+def test_stale_batch_is_not_replayed(app, company, verifactuxml, monkeypatch):
+    with app.app_context():
+        ids = invoices(company, 2)
+        record = db.session.get(Company, company)
+        verifactu = verifactuxml()
+
+        monkeypatch.setattr(verifactu, 'send_xml', lambda company, xml: {'status': 400, 'error': 'timeout', 'retry': True})
+        assert verifactu.lock(record)
+        assert verifactu.send(record, records(record, ids), False).get('error') == 'timeout'
+        CompanyLock.release(company, verifactu.lock_owner)
+
+        assert verifactu.load_batch(record, False, ids[1:]) is None
+        assert db.session.query(SubmissionBatch).filter_by(company_id=company).count() == 0
@@ -0,0 +1,59 @@
+#
+# Veri*Factu - 2025 Eduardo Ruiz <eruiz@dataclick.es>
+# https://github.com/EduardoRuizM/verifactu-api-python
+#
+
+from datetime import datetime
+
+from app import db, invoice_cache
+from app.models import Company, Invoice, InvoiceError, InvoiceLine
+
+
+def test_invoice_detail_cache_follows_replica(app, company, replicate, monkeypatch):
+    client = app.test_client()
+    with app.app_context():
+        invoice = Invoice(company_id=company, num=1, name='Cliente', verifactu_type='F2', dt=datetime(2025, 7, 1),
+                          verifactu_dt=datetime(2025, 7, 2), verifactu_err=0)
+        db.session.add(invoice)
+        db.session.commit()
+        id = invoice.id
+    replicate(Company, Invoice, InvoiceLine, InvoiceError)
+    url = f'/api/{company}/invoices/{id}'
+
+    resp = client.get(url)
+    etag = resp.headers['ETag']
+    assert resp.json['verifactu_dt'] is not None and (id, etag.strip('"')) in invoice_cache.items
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+
+    # Cached final body served with only the version lookup
+    monkeypatch.setattr(Invoice, 'to_lines_dict', lambda self: 1 / 0)
+    assert client.get(url).headers['ETag'] == etag
+    monkeypatch.undo()
+
+    # Changed by another process and replicated: new version, no invalidation needed
+    with app.app_context():
+        db.session.query(Invoice).filter_by(id=id).update({'voided': True})
+        db.session.commit()
+    replicate(Invoice)
+    resp = client.get(url)
+    assert resp.headers['ETag'] != etag and resp.json['voided']
+
+
+def test_local_error_changes_etag(app, company, replicate):
+    client = app.test_client()
+    with app.app_context():
+        invoice = Invoice(company_id=company, num=1, name='Cliente', verifactu_type='F2', dt=datetime(2025, 7, 1))
+        db.session.add(invoice)
+        db.session.commit()
+        id = invoice.id
+    replicate(Company, Invoice, InvoiceLine, InvoiceError)
+    url = f'/api/{company}/invoices/{id}'
+    etag = client.get(url).headers['ETag']
+
+    with app.app_context():
+        db.session.add(InvoiceError(invoice_id=id, created=datetime.now(), error='XSD test'))
+        db.session.commit()
+    replicate(InvoiceError)
+    resp = client.get(url, headers={'If-None-Match': etag})
+    assert resp.status_code == 200 and resp.json['local_error'] == 'XSD test'
+    assert resp.headers['ETag'] != etag
@@ -0,0 +1,46 @@
+#
+# Veri*Factu - 2025 Eduardo Ruiz <eruiz@dataclick.es>
+# https://github.com/EduardoRuizM/verifactu-api-python
+#
+
+from types import SimpleNamespace
+from datetime import datetime
+
+from app import db
+from app.models import Company
+
+
+def record(num, tvat=2.1, total=12.1):
+    return SimpleNamespace(get_number_format=lambda: num, dt=datetime(2025, 9, 1), verifactu_type='F1', tvat=tvat, total=total)
+
+
+def entry(verifactu, company, invoice, huella, prev, dt, voided=False):
+    data = {'Huella': huella, 'FechaHoraHusoGenRegistro': dt}
+    if not voided:
+        data.update({'TipoFactura': invoice.verifactu_type, 'CuotaTotal': invoice.tvat, 'ImporteTotal': invoice.total})
+    if prev:
+        data['Encadenamiento'] = {'RegistroAnterior': {'Huella': prev}}
+    return {'IDFactura': {'IDEmisorFactura': verifactu.cod(company.vat_id), 'NumSerieFactura': invoice.get_number_format(),
+                          'FechaExpedicionFactura': '01-09-2025'}, 'DatosRegistroFacturacion': data}
+
+
+def test_verify_chain_with_voids(app, company, verifactuxml, monkeypatch):
+    with app.app_context():
+        verifactu = verifactuxml()
+        record_company = db.session.get(Company, company)
+        a, b = record('A1'), record('A2')
+        dts = ['2025-09-01T10:00:00+02:00', '2025-09-01T11:00:00+02:00', '2025-09-01T12:00:00+02:00']
+
+        fp_a = verifactu.fingerprint(record_company, a, None, dts[0])
+        fp_void = verifactu.fingerprint(record_company, a, SimpleNamespace(fingerprint=fp_a), dts[1], True)
+        fp_b = verifactu.fingerprint(record_company, b, SimpleNamespace(fingerprint=fp_void), dts[2])
+        data = [entry(verifactu, record_company, a, fp_a, None, dts[0]),
+                entry(verifactu, record_company, a, fp_void, fp_a, dts[1], True),
+                entry(verifactu, record_company, b, fp_b, fp_void, dts[2])]
+
+        monkeypatch.setattr(verifactu, 'consulta', lambda company, year, month: {'data': data})
+        assert verifactu.verify_chain(record_company) == {'records': 3, 'ok': True, 'errors': []}
+
+        data[2]['DatosRegistroFacturacion']['Encadenamiento']['RegistroAnterior']['Huella'] = 'X' * 64
+        ret = verifactu.verify_chain(record_company)
+        assert [error['error'] for error in ret['errors']] == ['Huella', 'Encadenamiento']
@@ -0,0 +1,74 @@
+#
+# Veri*Factu - 2025 Eduardo Ruiz <eruiz@dataclick.es>
+# https://github.com/EduardoRuizM/verifactu-api-python
+#
+
+import io
+import csv
+import json
+import pytest
+
+from datetime import datetime
+
+from app import db
+from app.models import Company, Invoice, InvoiceLine
+
+
+@pytest.fixture
+def invoices(app, company, replicate):
+    with app.app_context():
+        with_lines = Invoice(company_id=company, num=1, name='Cliente "Uno", S.L.', verifactu_type='F1', dt=datetime(2025, 9, 1), bi=30, tvat=6.3, total=36.3)
+        without_lines = Invoice(company_id=company, num=2, name='Cliente Dos', verifactu_type='F2', dt=datetime(2025, 9, 2))
+        other = Invoice(company_id=company, num=3, name='Cliente Tres', verifactu_type='F2', dt=datetime(2025, 10, 1))
+        db.session.add_all([with_lines, without_lines, other])
+        db.session.flush()
+        db.session.add_all([InvoiceLine(invoice_id=with_lines.id, num=1, descr='Horas, "extra"\ny noche', units=1, price=10, vat=21, bi=10, tvat=2.1, total=12.1),
+                            InvoiceLine(invoice_id=with_lines.id, num=2, descr='Material', units=2, price=10, vat=21, bi=20, tvat=4.2, total=24.2)])
+        db.session.commit()
+        ids = [with_lines.id, without_lines.id, other.id]
+    replicate(Company, Invoice, InvoiceLine)
+    return ids
+
+
+def test_export_filters_types():
+    filters = Invoice.export_filters(types=' f1, F2 ,,')
+    assert len(filters) == 1
+    assert filters[0].right.value == ['F1', 'F2']
+    assert Invoice.export_filters(types=' , ') == []
+
+
+def test_export_filters_dates():
+    assert len(Invoice.export_filters('2025-01-01', '2025-01-01')) == 2
+    with pytest.raises(ValueError, match='YYYY-MM-DD'):
+        Invoice.export_filters('2025-13-01')
+    with pytest.raises(ValueError, match='range'):
+        Invoice.export_filters('2025-02-01', '2025-01-31')
+
+
+
+def test_export_ndjson(app, company, invoices):
+    resp = app.test_client().get(f'/api/{company}/export?from=2025-09-01&to=2025-09-30')
+    assert resp.status_code == 200 and resp.mimetype == 'application/x-ndjson'
+
+    rows = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+    assert [row['id'] for row in rows] == invoices[:2]
+    assert [line['descr'] for line in rows[0]['lines']] == ['Horas, "extra"\ny noche', 'Material']
+    assert rows[1]['lines'] == [] and rows[1]['dt'] == '2025-09-02 00:00:00'
+
+
+def test_export_csv(app, company, invoices):
+    resp = app.test_client().get(f'/api/{company}/export?format=csv&type=f1,F2&to=2025-09-30')
+    assert resp.status_code == 200 and resp.mimetype == 'text/csv'
+    assert resp.headers['Content-Disposition'] == f'attachment; filename=invoices_{company}.csv'
+
+    rows = list(csv.DictReader(io.StringIO(resp.get_data(as_text=True))))
+    assert [int(row['id']) for row in rows] == [invoices[0], invoices[0], invoices[1]]
+    assert rows[0]['name'] == 'Cliente "Uno", S.L.' and rows[0]['line_descr'] == 'Horas, "extra"\ny noche'
+    assert rows[1]['line_num'] == '2' and rows[2]['line_num'] == '' and rows[2]['line_descr'] == ''
+
+
+def test_export_errors(app, company, invoices):
+    client = app.test_client()
+    assert client.get(f'/api/{company}/export?format=xml').status_code == 400
+    assert client.get(f'/api/{company}/export?from=2025-10-01&to=2025-09-01').json['error'].startswith('Invalid range')
+    assert client.get('/api/0/export').status_code == 404
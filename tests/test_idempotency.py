@@ -0,0 +1,89 @@
+#
+# Veri*Factu - 2025 Eduardo Ruiz <eruiz@dataclick.es>
+# https://github.com/EduardoRuizM/verifactu-api-python
+#
+
+import json
+import hashlib
+
+from http import HTTPStatus
+from datetime import timedelta
+
+from app import db
+from app.models import IdempotencyKey, Invoice, db_now
+
+
+def keys(app, company_id):
+    with app.app_context():
+        return [k.key for k in IdempotencyKey.query.filter_by(company_id=company_id).all()]
+
+
+def test_rejected_body_releases_key(app, company):
+    client = app.test_client()
+    headers = {'Idempotency-Key': 'retry-1'}
+
+    resp = client.post(f'/api/{company}/invoices', data='x', headers=headers)
+    assert resp.status_code == HTTPStatus.UNSUPPORTED_MEDIA_TYPE
+    resp = client.post(f'/api/{company}/invoices', data='null', content_type='application/json', headers=headers)
+    assert resp.status_code == HTTPStatus.UNSUPPORTED_MEDIA_TYPE
+    assert keys(app, company) == []
+
+    resp = client.post(f'/api/{company}/invoices', json={'unknown': 1}, headers=headers)
+    assert resp.status_code != HTTPStatus.CONFLICT
+    assert keys(app, company) == []
+
+
+def test_claim_purges_expired(app, company):
+    with app.app_context():
+        now = db_now()
+        db.session.add(IdempotencyKey(company_id=company, key='old', request_hash='x', claimed=now, expires=now - timedelta(seconds=1)))
+        db.session.commit()
+
+        id, status = IdempotencyKey.claim(company, 'new', 'x', 60)
+        assert status is None
+        assert keys(app, company) == ['new']
+
+        _, status = IdempotencyKey.claim(company, 'new', 'x', 60)
+        assert status == HTTPStatus.CONFLICT
+        IdempotencyKey.release(id)
+    assert keys(app, company) == []
+
+
+def test_replay_returns_original(app, company):
+    client = app.test_client()
+    body = {'name': 'Cliente', 'lines': [{'descr': 'A', 'units': 1, 'price': 10, 'vat': 21}]}
+    headers = {'Idempotency-Key': 'pos-1'}
+
+    first = client.post(f'/api/{company}/invoices', json=body, headers=headers)
+    second = client.post(f'/api/{company}/invoices', json=body, headers=headers)
+    assert first.status_code == second.status_code == HTTPStatus.CREATED
+    assert first.json == second.json
+    with app.app_context():
+        assert db.session.query(Invoice).filter_by(company_id=company).count() == 1
+
+    other = client.post(f'/api/{company}/invoices', json={**body, 'name': 'Otro'}, headers=headers)
+    assert other.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+    with app.app_context():
+        assert db.session.query(Invoice).filter_by(company_id=company).count() == 1
+
+
+def test_stale_claim_is_taken_over(app, company):
+    client = app.test_client()
+    body = {'name': 'Cliente', 'lines': [{'descr': 'A', 'units': 1, 'price': 10, 'vat': 21}]}
+    headers = {'Idempotency-Key': 'pos-2'}
+
+    with app.app_context():
+        # Same request as the retry, crashed before completing
+        request_hash = hashlib.sha256(f'/api/{company}/invoices|{json.dumps(body, sort_keys=True)}'.encode()).hexdigest()
+        id, status = IdempotencyKey.claim(company, 'pos-2', request_hash, 60)
+        assert status is None
+
+        assert client.post(f'/api/{company}/invoices', json=body, headers=headers).status_code == HTTPStatus.CONFLICT
+
+        db.session.query(IdempotencyKey).filter_by(id=id).update({'claimed': db_now() - timedelta(seconds=120)})
+        db.session.commit()
+
+    resp = client.post(f'/api/{company}/invoices', json=body, headers=headers)
+    assert resp.status_code == HTTPStatus.CREATED
+    with app.app_context():
+        assert db.session.get(IdempotencyKey, id).invoice_id == resp.json['id']
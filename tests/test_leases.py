@@ -0,0 +1,211 @@
+#
+# Veri*Factu - 2025 Eduardo Ruiz <eruiz@dataclick.es>
+# https://github.com/EduardoRuizM/verifactu-api-python
+#
+
+import re
+import time
+import threading
+
+from datetime import datetime, timedelta
+
+from app import db
+from app.models import Company, CompanyLease, CompanyLock, Invoice, InvoiceRecord, Worker, db_now
+from conftest import aeat_response
+
+
+def run(workers, target):
+    errors = []
+
+    def wrap(n):
+        try:
+            target(n)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=wrap, args=(n,)) for n in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+
+
+def test_concurrent_voids_send_once(app, company, verifactuxml):
+    with app.app_context():
+        invoices = [Invoice(company_id=company, num=num, name='Cliente', verifactu_type='F2', dt=datetime(2025, 6, num),
+                            verifactu_dt=datetime(2025, 6, 10), verifactu_err=0) for num in range(1, 4)]
+        db.session.add_all(invoices)
+        db.session.commit()
+        ids = [invoice.id for invoice in invoices]
+        nums = sorted(invoice.get_number_format() for invoice in invoices)
+
+    sent = []
+    active = []
+    lock = threading.Lock()
+
+    def worker(n):
+        with app.app_context():
+            verifactu = verifactuxml()
+            verifactu.worker_id = f'worker-{n}'
+
+            def send_xml(company, xml):
+                with lock:
+                    active.append(n)
+                    assert len(active) == 1
+                    sent.extend(re.findall(r'<NumSerieFacturaAnulada>([^<]+)</NumSerieFacturaAnulada>', xml))
+                time.sleep(0.2)
+                db.session.query(Invoice).filter(Invoice.id.in_(ids)).update({'voided': True})
+                db.session.commit()
+                with lock:
+                    active.remove(n)
+                return {'status': 400, 'error': 'stub', 'response': ''}
+
+            verifactu.send_xml = send_xml
+            record = db.session.get(Company, company)
+            ret = verifactu.voided(record, InvoiceRecord.select(record, Invoice.id.in_(ids)))
+            assert ret.get('error') == 'stub' or ret.get('message') == 'No invoices to send'
+
+    run(4, worker)
+    assert sorted(sent) == nums
+
+
+def test_lock_is_exclusive(app, company):
+    holders = []
+    counts = []
+    lock = threading.Lock()
+
+    def worker(n):
+        with app.app_context():
+            for _ in range(5):
+                while not CompanyLock.acquire(company, f'worker-{n}', 60):
+                    time.sleep(0.01)
+                with lock:
+                    holders.append(n)
+                    counts.append(len(holders))
+                time.sleep(0.01)
+                with lock:
+                    holders.remove(n)
+                CompanyLock.release(company, f'worker-{n}')
+
+    run(4, worker)
+    assert len(counts) == 20 and max(counts) == 1
+
+
+def test_lock_renew_and_takeover(app, company):
+    with app.app_context():
+        assert CompanyLock.acquire(company, 'a', 60)
+        assert not CompanyLock.acquire(company, 'b', 60)
+        assert CompanyLock.renew(company, 'a', 60)
+
+        db.session.query(CompanyLock).filter_by(company_id=company).update({'expires': db_now() - timedelta(seconds=1)})
+        db.session.commit()
+        assert CompanyLock.acquire(company, 'b', 60)
+        assert not CompanyLock.renew(company, 'a', 60)
+        CompanyLock.release(company, 'b')
+
+
+def companies(app, count, invoices=0):
+    with app.app_context():
+        items = [Company(name=f'Lease {n} {time.time_ns()}', vat_id=f'B{n}{time.time_ns()}', created=datetime.now()) for n in range(count)]
+        db.session.add_all(items)
+        db.session.commit()
+        for company in items:
+            db.session.add_all([Invoice(company_id=company.id, num=num, name='Cliente', verifactu_type='F2', dt=datetime(2025, 8, num),
+                                        bi=10, tvat=2.1, total=12.1) for num in range(1, invoices + 1)])
+        db.session.commit()
+        return [company.id for company in items]
+
+
+def test_lease_limit_and_surplus(app):
+    ids = companies(app, 3)
+    with app.app_context():
+        assert CompanyLease.acquire(ids[0], 'a', 60, 2)
+        assert CompanyLease.acquire(ids[1], 'a', 60, 2)
+        assert not CompanyLease.acquire(ids[2], 'a', 60, 2)
+        assert CompanyLease.acquire(ids[2], 'b', 60, 2)
+        assert not CompanyLease.acquire(ids[2], 'a', 60)
+
+        # Another node joined: a gives up the surplus lease
+        assert not CompanyLease.acquire(ids[1], 'a', 60, 1)
+        assert CompanyLease.acquire(ids[1], 'b', 60, 2)
+        CompanyLease.release_all('a')
+        CompanyLease.release_all('b')
+        assert db.session.query(CompanyLease).filter(CompanyLease.company_id.in_(ids)).count() == 0
+
+
+def test_lease_takeover_after_expiry(app):
+    ids = companies(app, 2)
+    with app.app_context():
+        assert CompanyLease.acquire(ids[0], 'dead', 60)
+        assert CompanyLease.acquire(ids[1], 'dead', 60)
+        assert not CompanyLease.acquire(ids[0], 'alive', 60)
+
+        db.session.query(CompanyLease).filter_by(owner='dead').update({'expires': db_now() - timedelta(seconds=1)})
+        db.session.commit()
+        assert CompanyLease.acquire(ids[0], 'alive', 60, 2)
+        assert CompanyLease.acquire(ids[1], 'alive', 60, 2)
+        assert db.session.query(CompanyLease).filter_by(owner='dead').count() == 0
+        CompanyLease.release_all('alive')
+
+
+def test_concurrent_leases_spread(app):
+    ids = companies(app, 8)
+    owners = {}
+    lock = threading.Lock()
+
+    def worker(n):
+        with app.app_context():
+            for id in ids:
+                if CompanyLease.acquire(id, f'node-{n}', 60, 2):
+                    with lock:
+                        owners.setdefault(id, []).append(n)
+
+    run(4, worker)
+    assert sorted(owners) == sorted(ids)
+    assert all(len(nodes) == 1 for nodes in owners.values())
+    assert max(sum(nodes == [n] for nodes in owners.values()) for n in range(4)) <= 2
+    with app.app_context():
+        for n in range(4):
+            CompanyLease.release_all(f'node-{n}')
+
+
+def test_concurrent_process_sends_once(app, verifactuxml):
+    ids = companies(app, 3, 2)
+    with app.app_context():
+        db.session.query(Worker).delete()
+        db.session.commit()
+
+    sent = []
+    active = set()
+    lock = threading.Lock()
+
+    def worker(n):
+        with app.app_context():
+            verifactu = verifactuxml()
+            verifactu.worker_id = f'node-{n}'
+
+            def send_xml(company, xml):
+                with lock:
+                    assert company.id not in active
+                    active.add(company.id)
+                nums = re.findall(r'<IDFactura><IDEmisorFactura>[^<]*</IDEmisorFactura><NumSerieFactura>([^<]+)</NumSerieFactura>',
+                                  re.sub(r'>\s+<', '><', xml))
+                time.sleep(0.1)
+                with lock:
+                    sent.extend((company.id, num) for num in nums)
+                    active.discard(company.id)
+                return {'status': 200, 'error': None, 'response': aeat_response([(num, 0) for num in nums])}
+
+            verifactu.send_xml = send_xml
+            verifactu.pending()
+
+    for _ in range(3):
+        run(4, worker)
+
+    ours = sorted(item for item in sent if item[0] in ids)
+    assert ours == sorted(set(ours)) and len(ours) == 6
+    with app.app_context():
+        assert db.session.query(Invoice).filter(Invoice.company_id.in_(ids), Invoice.verifactu_dt.is_(None)).count() == 0
+        assert db.session.query(CompanyLease).filter(CompanyLease.owner.like('node-%')).count() == 0
+        assert db.session.query(Worker).filter(Worker.id.like('node-%')).count() == 0
@@ -0,0 +1,64 @@
+#
+# Veri*Factu - 2025 Eduardo Ruiz <eruiz@dataclick.es>
+# https://github.com/EduardoRuizM/verifactu-api-python
+#
+
+import pytest
+
+from flask import g
+from sqlalchemy import event
+from datetime import datetime
+
+from app import db
+from app.models import Company, Invoice
+
+
+@pytest.fixture
+def statements(app):
+    counts = {'primary': 0, 'read': 0}
+    with app.app_context():
+        engines = {'primary': db.engine, 'read': db.engines['read']}
+
+    def listener(name):
+        def count(*args):
+            counts[name] += 1
+        return count
+
+    listeners = [(engine, listener(name)) for name, engine in engines.items()]
+    for engine, func in listeners:
+        event.listen(engine, 'before_cursor_execute', func)
+    yield counts
+    for engine, func in listeners:
+        event.remove(engine, 'before_cursor_execute', func)
+
+
+def test_read_only_bind(app):
+    with app.test_request_context():
+        assert db.session.get_bind(Invoice.__mapper__) is db.engine
+        g.read_only = True
+        assert db.session.get_bind(Invoice.__mapper__) is db.engines['read']
+
+
+def test_read_only_flush_uses_primary(app):
+    with app.test_request_context():
+        g.read_only = True
+        db.session.add(Company(name='Flush', vat_id='B11111111', created=datetime.now()))
+        db.session.commit()
+
+        g.read_only = False
+        assert db.session.query(Company).filter_by(vat_id='B11111111').count() == 1
+        g.read_only = True
+        assert db.session.query(Company).filter_by(vat_id='B11111111').count() == 0
+
+
+@pytest.mark.parametrize('url', ['/api/{}/invoices', '/api/{}/invoices/1', '/api/{}/invoices/1/qr'])
+def test_read_only_routes(app, company, statements, url):
+    app.test_client().get(url.format(company))
+    assert statements['read'] > 0
+    assert statements['primary'] == 0
+
+
+def test_other_routes_use_primary(app, statements):
+    app.test_client().get('/api/999999/query')
+    assert statements['primary'] > 0
+    assert statements['read'] == 0
@@ -0,0 +1,81 @@
+#
+# Veri*Factu - 2025 Eduardo Ruiz <eruiz@dataclick.es>
+# https://github.com/EduardoRuizM/verifactu-api-python
+#
+
+import pytest
+
+from datetime import datetime
+
+from app import db
+from app.models import Company, Invoice, InvoiceError, InvoiceRecord
+
+pytest.importorskip('lxml')
+
+XSD = '''<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema" elementFormDefault="qualified"
+    targetNamespace="https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aplicaciones/es/aeat/tike/cont/ws/SuministroLR.xsd">
+  <xs:element name="RegFactuSistemaFacturacion"><xs:complexType><xs:sequence>
+    <xs:element name="Cabecera"><xs:complexType><xs:sequence><xs:any processContents="skip"/></xs:sequence></xs:complexType></xs:element>
+    <xs:element name="RegistroFactura"><xs:complexType/></xs:element>
+  </xs:sequence></xs:complexType></xs:element>
+</xs:schema>'''
+
+# Same schema with RegistroFactura accepting anything, defined in a file included by absolute URL
+LOOSE = XSD.replace('<xs:element name="RegistroFactura"><xs:complexType/></xs:element>', '<xs:element ref="sum:RegistroFactura"/>').replace(
+    'elementFormDefault', 'xmlns:sum="https://www2.agenciatributaria.gob.es/static_files/common/internet/dep/aplicaciones/es/aeat/tike/cont/ws/SuministroLR.xsd" elementFormDefault').replace(
+    '<xs:element name="RegFactuSistemaFacturacion">', '<xs:include schemaLocation="https://www.example.invalid/xsd/Registro.xsd"/>\n  <xs:element name="RegFactuSistemaFacturacion">')
+REGISTRO = XSD.split('<xs:element')[0] + '''<xs:element name="RegistroFactura"><xs:complexType><xs:sequence>
+    <xs:any processContents="skip" minOccurs="0" maxOccurs="unbounded"/></xs:sequence></xs:complexType></xs:element>
+</xs:schema>'''
+
+
+def test_invalid_record_is_held(app, company, verifactuxml, tmp_path):
+    (tmp_path / 'SuministroLR.xsd').write_text(XSD)
+    with app.app_context():
+        invoice = Invoice(company_id=company, num=1, name='Cliente', verifactu_type='F2', dt=datetime(2025, 5, 1))
+        db.session.add(invoice)
+        db.session.commit()
+
+        held = []
+        record = db.session.get(Company, company)
+        batch_id, last_map, dt, xml = verifactuxml().build(record, InvoiceRecord.select(record), held)
+
+        assert batch_id is None and not last_map
+        assert held[0]['id'] == invoice.id and held[0]['codError'] == 'XSD'
+        assert db.session.get(InvoiceError, invoice.id).error.startswith('XSD')
+        assert invoice.to_lines_dict()['local_error'].startswith('XSD')
+
+
+def test_validation_disabled_is_logged_once(app, verifactuxml, tmp_path):
+    with app.app_context():
+        verifactu = verifactuxml()
+        assert verifactu.schema() is None
+        assert verifactu.schema() is None
+    assert (tmp_path / 'verifactu.log').read_text().count('XSD validation disabled') == 1
+
+
+def test_held_record_is_retried(app, company, verifactuxml, tmp_path):
+    (tmp_path / 'SuministroLR.xsd').write_text(XSD)
+    with app.app_context():
+        invoice = Invoice(company_id=company, num=1, name='Cliente', verifactu_type='F2', dt=datetime(2025, 5, 2))
+        db.session.add(invoice)
+        db.session.commit()
+
+        verifactu = verifactuxml()
+        record = db.session.get(Company, company)
+        verifactu.build(record, InvoiceRecord.select(record, Invoice.id == invoice.id), [])
+        assert db.session.get(InvoiceError, invoice.id)
+
+        # Corrected schema (or record): the next run builds it and clears the error
+        fixed = tmp_path / 'fixed'
+        fixed.mkdir()
+        (fixed / 'SuministroLR.xsd').write_text(LOOSE)
+        (fixed / 'Registro.xsd').write_text(REGISTRO)
+        verifactu.xsd_path = str(fixed)
+        assert verifactu.schema() is not None
+        held = []
+        batch_id, last_map, dt, xml = verifactu.build(record, InvoiceRecord.select(record, Invoice.id == invoice.id), held)
+
+        assert batch_id and invoice.id in last_map and not held
+        assert db.session.get(InvoiceError, invoice.id) is None
+        assert invoice.to_lines_dict()['local_error'] is None
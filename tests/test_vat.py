@@ -0,0 +1,114 @@
+#
+# Veri*Factu - 2025 Eduardo Ruiz <eruiz@dataclick.es>
+# https://github.com/EduardoRuizM/verifactu-api-python
+#
+
+import re
+
+from http import HTTPStatus
+
+from app import db
+from app.models import Company, CompanyLock, Invoice, InvoiceLine, InvoiceRecord, InvoiceVatTotal, VatRollup
+from conftest import aeat_response
+
+LINES = [{'descr': 'A', 'units': 2, 'price': 10, 'vat': 21},
+         {'descr': 'B', 'units': 1, 'price': 5, 'vat': 21},
+         {'descr': 'C', 'units': 1, 'price': 3, 'vat': 0}]
+
+
+def create(app, company, lines=LINES):
+    resp = app.test_client().post(f'/api/{company}/invoices', json={'name': 'Cliente', 'lines': lines})
+    assert resp.status_code == HTTPStatus.CREATED, resp.json
+    return resp.json['id']
+
+
+def rollup(company):
+    return {row.vat: row for row in db.session.query(VatRollup).filter_by(company_id=company).all()}
+
+
+def test_process_lines_totals(app, company):
+    ids = [create(app, company), create(app, company)]
+    with app.app_context():
+        totals = {row.vat: (row.bi, row.tvat) for row in db.session.query(InvoiceVatTotal).filter_by(invoice_id=ids[0])}
+        assert totals == {21: (25.0, 5.25), 0: (3.0, 0.0)}
+        invoice = db.session.get(Invoice, ids[0])
+        assert (invoice.bi, invoice.tvat, invoice.total) == (28.0, 5.25, 33.25)
+
+        rows = rollup(company)
+        assert (rows[21].invoices, rows[21].bi, rows[21].tvat) == (2, 50.0, 10.5)
+        assert (rows[0].invoices, rows[0].bi, rows[0].sent) == (2, 6.0, 0)
+
+
+def test_write_back_rollups(app, company, verifactuxml, monkeypatch, replicate):
+    ids = [create(app, company), create(app, company)]
+    with app.app_context():
+        record = db.session.get(Company, company)
+        verifactu = verifactuxml()
+        invoices = InvoiceRecord.select(record, Invoice.id.in_(ids), order_by=Invoice.id)
+        nums = [invoice.get_number_format() for invoice in invoices]
+        year = db.session.get(Invoice, ids[0]).dt.year
+
+        monkeypatch.setattr(verifactu, 'send_xml', lambda company, xml: {
+            'status': 200, 'error': None, 'response': aeat_response([(nums[0], 0), (nums[1], 1100)])})
+        assert verifactu.lock(record)
+        ret = verifactu.send(record, invoices)
+        CompanyLock.release(company, verifactu.lock_owner)
+        assert [item['id'] for item in ret['ok']] == ids[:1] and ret['ko'][0]['id'] == ids[1]
+        assert rollup(company)[21].sent == 1
+
+        # Void of the rejected alta: RechazoPrevio, verifactu_err back to 0 so it counts as sent
+        monkeypatch.setattr(verifactu, 'send_xml', lambda company, xml: {
+            'status': 200, 'error': None, 'response': aeat_response([(nums[1], 0)])})
+        ret = verifactu.voided(record, [db.session.get(Invoice, ids[1])])
+        assert [item['id'] for item in ret['ok']] == ids[1:]
+        rows = rollup(company)
+        assert (rows[21].sent, rows[21].voided, rows[21].voided_bi) == (2, 1, 25.0)
+        assert VatRollup.report(company, year, 'year', 0, True)['verify']['ok']
+
+    replicate(Company, Invoice, InvoiceVatTotal, VatRollup)
+    client = app.test_client()
+    resp = client.get(f'/api/{company}/reports/vat?year={year}&period=year&verify=1')
+    assert resp.status_code == HTTPStatus.OK
+    assert resp.json['verify'] == {'ok': True, 'differences': []}
+    item = next(item for item in resp.json['data'] if item['vat'] == 21)
+    assert (item['period'], item['invoices'], item['sent'], item['voided']) == (str(year), 2, 2, 1)
+    assert 'no-cache' in resp.headers['Cache-Control']
+    assert client.get(f'/api/{company}/reports/vat?year={year}&period=year&verify=1',
+                      headers={'If-None-Match': resp.headers['ETag']}).status_code == HTTPStatus.NOT_MODIFIED
+
+
+def test_report_invalid_period(app, company):
+    assert app.test_client().get(f'/api/{company}/reports/vat?period=week').status_code == HTTPStatus.BAD_REQUEST
+
+
+def test_desglose_matches_lines(app, company, verifactuxml):
+    lines = LINES + [{'descr': 'D', 'units': 3, 'price': 1.15, 'vat': 10}, {'descr': 'E', 'units': 1, 'price': 0.99, 'vat': 10}]
+    id = create(app, company, lines)
+    with app.app_context():
+        record = db.session.get(Company, company)
+        invoice = InvoiceRecord.select(record, Invoice.id == id)[0]
+        xml = verifactuxml().registro_alta(record, invoice, None, '2025-06-01T10:00:00+02:00')
+        desglose = {int(vat or 0): (bi, tvat) for vat, bi, tvat in re.findall(
+            r'<DetalleDesglose>.*?(?:<TipoImpositivo>(\d+)</TipoImpositivo>)?<BaseImponibleOimporteNoSujeto>([\d.]+)</BaseImponibleOimporteNoSujeto>'
+            r'(?:<CuotaRepercutida>([\d.]+)</CuotaRepercutida>)?.*?</DetalleDesglose>', re.sub(r'>\s+<', '><', xml))}
+
+        # Aggregation over invoice_lines used before invoice_vat_totals
+        old = db.session.query(db.func.sum(InvoiceLine.bi), db.func.sum(InvoiceLine.tvat), InvoiceLine.vat
+                               ).filter(InvoiceLine.invoice_id == id).group_by(InvoiceLine.vat).all()
+        assert desglose == {vat or 0: (f'{bi:.2f}', f'{tvat:.2f}' if vat else '') for bi, tvat, vat in old}
+
+
+def test_vat_totals_backfill_once(app, company):
+    id = create(app, company)
+    with app.app_context():
+        expected = sorted((row.vat, row.bi, row.tvat) for row in db.session.query(InvoiceVatTotal).filter_by(invoice_id=id))
+        db.session.query(InvoiceVatTotal).delete()
+        db.session.commit()
+
+        InvoiceVatTotal.backfill()
+        assert sorted((row.vat, row.bi, row.tvat) for row in db.session.query(InvoiceVatTotal).filter_by(invoice_id=id)) == expected
+
+        db.session.query(InvoiceVatTotal).filter_by(invoice_id=id, vat=0).delete()
+        db.session.commit()
+        InvoiceVatTotal.backfill()
+        assert db.session.query(InvoiceVatTotal).filter_by(invoice_id=id, vat=0).first() is None